@@ -31,6 +31,7 @@ DJANGO_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 ]
 
 INSTALLED_APPS = INTERNAL_APPS + DJANGO_APPS
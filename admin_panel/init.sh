@@ -2,5 +2,9 @@
 
 python manage.py makemigrations
 python manage.py migrate
+# Сводка веток каталога для навигации в боте (после миграции, добавившей поля, и правок в обход админки)
+python manage.py refresh_catalog_stats
+# Вопросы FAQ по умолчанию, только в пустую таблицу
+python manage.py seed_faq
 
 gunicorn -w 4 -k uvicorn.workers.UvicornWorker config.asgi:application --bind 0.0.0.0:8000
\ No newline at end of file
@@ -1,11 +1,23 @@
 from django.contrib import admin
 
-from .models import Category, Product, Promo, Subcategory, User, UserBot
+from .models import (
+    FAQ,
+    Category,
+    Order,
+    OrderItem,
+    OrderStatusChange,
+    Product,
+    Promo,
+    PromoShard,
+    Subcategory,
+    User,
+    UserBot,
+)
 
 
 @admin.register(Category)
 class AdminCategory(admin.ModelAdmin):
-    list_display = ['name']
+    list_display = ['name', 'product_count', 'min_price', 'max_price']
     prepopulated_fields = {
         'slug': ['name'],
     }
@@ -13,7 +25,7 @@ class AdminCategory(admin.ModelAdmin):
 
 @admin.register(Subcategory)
 class AdminSubcategory(admin.ModelAdmin):
-    list_display = ['name', 'category']
+    list_display = ['name', 'category', 'product_count', 'min_price', 'max_price']
     list_select_related = ['category']
     prepopulated_fields = {
         'slug': ['name'],
@@ -26,9 +38,22 @@ class AdminProduct(admin.ModelAdmin):
     list_select_related = ['subcategory']
 
 
+class PromoShardInline(admin.TabularInline):
+    model = PromoShard
+    extra = 0
+    can_delete = False
+    readonly_fields = [
+        'start_id', 'end_id', 'last_sent_user_id', 'lease_owner', 'lease_expires_at', 'sent', 'failed', 'done_at',
+    ]
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Promo)
 class AdminPromo(admin.ModelAdmin):
     list_display = ['name', 'start_time', 'active', 'last_succeeded_at']
+    inlines = [PromoShardInline]
 
 
 @admin.register(User)
@@ -39,3 +64,32 @@ class AdminUser(admin.ModelAdmin):
 @admin.register(UserBot)
 class AdminCustomer(admin.ModelAdmin):
     list_display = ['id', 'first_name', 'is_admin', 'is_staff']
+
+
+class OrderItemInline(admin.TabularInline):
+    model = OrderItem
+    extra = 0
+    readonly_fields = ['product_id', 'name', 'price', 'quantity']
+
+
+class OrderStatusChangeInline(admin.TabularInline):
+    model = OrderStatusChange
+    extra = 0
+    can_delete = False
+    readonly_fields = ['old_status', 'new_status', 'changed_at']
+
+
+@admin.register(Order)
+class AdminOrder(admin.ModelAdmin):
+    list_display = ['id', 'client_username', 'paid_amount', 'status', 'created_at']
+    list_filter = ['status']
+    search_fields = ['provider_payment_charge_id', 'client_username', 'phone']
+    inlines = [OrderItemInline, OrderStatusChangeInline]
+
+
+@admin.register(FAQ)
+class AdminFAQ(admin.ModelAdmin):
+    list_display = ['question', 'position']
+    list_editable = ['position']
+    ordering = ['position', 'id']
+    search_fields = ['question']
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from panel.models import Category, Subcategory
+from panel.signals import CATALOG_CHANNEL, notify
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает число товаров и диапазон цен категорий и подкатегорий'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            subcategories = Subcategory.objects.all().refresh_stats()
+            categories = Category.objects.all().refresh_stats()
+            # Бот сбросит кэш каталога целиком
+            notify(CATALOG_CHANNEL, {'model': 'all'})
+        self.stdout.write(f'Пересчитано категорий: {categories}, подкатегорий: {subcategories}')
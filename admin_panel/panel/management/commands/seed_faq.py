@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from panel.models import FAQ
+from panel.signals import FAQ_CHANNEL, notify
+
+# Вопросы, которые раньше были зашиты в бот (bot/src/faq/router.py)
+DEFAULT_FAQ = [
+    ('Как зарегистрироваться?', 'Нажмите /start и следуйте инструкциям.'),
+    ('Как изменить пароль?', "Перейдите в настройки и выберите 'Сменить пароль'."),
+    ('Что делать, если забыл пароль?', "Используйте функцию 'Восстановить пароль' на сайте."),
+    ('Как связаться с поддержкой?', 'Напишите на support@example.com.'),
+]
+
+
+class Command(BaseCommand):
+    help = 'Заполняет FAQ вопросами по умолчанию, если таблица пуста'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if FAQ.objects.exists():
+                self.stdout.write('FAQ уже заполнен, пропускаю')
+                return
+            FAQ.objects.bulk_create(
+                FAQ(question=question, answer=answer, position=position)
+                for position, (question, answer) in enumerate(DEFAULT_FAQ)
+            )
+            # bulk_create не вызывает сигналы
+            notify(FAQ_CHANNEL, {'id': None})
+        self.stdout.write(f'Добавлено вопросов: {len(DEFAULT_FAQ)}')
@@ -1,8 +1,12 @@
 from uuid import uuid4
 
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.core.validators import MinValueValidator, URLValidator
 from django.db import models
+from django.db.models import Count, Max, Min, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, Now
 from slugify import slugify
 
 
@@ -18,9 +22,59 @@ class UserBot(models.Model):
     is_staff = models.BooleanField(default=False)
 
 
+class FSMState(models.Model):
+    """Состояние FSM бота (корзина, навигация, данные заказа), пишет только бот."""
+    key = models.CharField(max_length=255, primary_key=True)
+    state = models.CharField(max_length=255, blank=True, null=True)
+    data = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(db_default=Now())
+
+
+class ProcessedUpdate(models.Model):
+    """id апдейтов Telegram, уже принятых ботом в режиме вебхука (защита от повторной доставки)."""
+    update_id = models.BigIntegerField(primary_key=True)
+    created_at = models.DateTimeField(db_default=Now(), db_index=True)
+
+
+class CategoryQuerySet(models.QuerySet):
+    def refresh_stats(self) -> int:
+        """Пересчитывает счетчики категорий по уже пересчитанным подкатегориям."""
+        subcategories = Subcategory.objects.filter(category=OuterRef('pk')).values('category')
+        return self.update(
+            product_count=Coalesce(Subquery(subcategories.annotate(value=Sum('product_count')).values('value')), 0),
+            min_price=Subquery(subcategories.annotate(value=Min('min_price')).values('value')),
+            max_price=Subquery(subcategories.annotate(value=Max('max_price')).values('value')),
+        )
+
+
+class SubcategoryQuerySet(models.QuerySet):
+    def refresh_stats(self) -> int:
+        """Пересчитывает число товаров и диапазон цен подкатегорий."""
+        products = Product.objects.filter(subcategory=OuterRef('pk')).values('subcategory')
+        return self.update(
+            product_count=Coalesce(Subquery(products.annotate(value=Count('pk')).values('value')), 0),
+            min_price=Subquery(products.annotate(value=Min('price')).values('value')),
+            max_price=Subquery(products.annotate(value=Max('price')).values('value')),
+        )
+
+
 class Category(models.Model):
     name = models.CharField(max_length=120)
     slug = models.SlugField(max_length=120, blank=True)
+    # Денормализованная сводка по веткам каталога для навигации в боте:
+    # пустые ветки скрываются, а счетчики выводятся на кнопках без подсчета на каждый запрос.
+    # Обновляется сигналами (signals.py), полный пересчет - manage.py refresh_catalog_stats
+    product_count = models.PositiveIntegerField(default=0, db_default=0, editable=False)
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, editable=False)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, editable=False)
+
+    objects = CategoryQuerySet.as_manager()
+
+    class Meta:
+        # Keyset-пагинация в боте: ORDER BY name, id, пустые ветки не показываются
+        indexes = [
+            models.Index(fields=['name', 'id'], condition=Q(product_count__gt=0), name='category_nav_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -35,6 +89,18 @@ class Subcategory(models.Model):
     name = models.CharField(max_length=120)
     slug = models.SlugField(max_length=120, blank=True)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='subcategories')
+    product_count = models.PositiveIntegerField(default=0, db_default=0, editable=False)
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, editable=False)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, editable=False)
+
+    objects = SubcategoryQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['category', 'name', 'id'], condition=Q(product_count__gt=0), name='subcategory_nav_idx',
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -58,14 +124,143 @@ class Product(models.Model):
         related_name='products',
     )
     image = models.URLField(validators=[URLValidator()])
+    # Увеличивается при каждом сохранении, бот по ней отбрасывает устаревшие копии из кэша
+    version = models.PositiveIntegerField(default=1, editable=False)
+    # Инлайн-поиск товаров в боте (@bot товар ...)
+    search_vector = models.GeneratedField(
+        expression=(
+            SearchVector('name', weight='A', config='russian')
+            + SearchVector('description', weight='B', config='russian')
+        ),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['subcategory', 'name', 'id']),
+            GinIndex(fields=['search_vector']),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self.version += 1
+        return super().save(*args, **kwargs)
 
 
 class Promo(models.Model):
     name = models.CharField(max_length=156)
     text = models.TextField(help_text='Текст промо с MARKDOWN_V2 разметкой')
     cover = models.URLField(validators=[URLValidator()], help_text='Ссылка на изображение')
+    cover_file_id = models.CharField(
+        max_length=256,
+        blank=True,
+        null=True,
+        editable=False,
+        help_text='file_id обложки в Telegram, заполняется ботом после первой отправки',
+    )
     text_link = models.CharField(max_length=64, default='Перейти', help_text='Текст для кнопки')
     link = models.URLField(validators=[URLValidator()], help_text='Ссылка для встраивания в кнопку')
     start_time = models.DateTimeField(help_text='Дата и время начала рассылки, UTC')
     last_succeeded_at = models.DateTimeField(blank=True, null=True, help_text='Последнее успешное выполнение, UTC')
     active = models.BooleanField(default=True)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            old = Promo.objects.filter(pk=self.pk).values('cover', 'active').first()
+            # file_id относится к старой картинке, при смене ссылки бот загрузит новую
+            if old and old['cover'] != self.cover:
+                self.cover_file_id = None
+            # Повторный запуск: прошлое разбиение на шарды и их чекпоинты больше не нужны
+            if old and not old['active'] and self.active:
+                self.shards.all().delete()
+        return super().save(*args, **kwargs)
+
+
+class PromoShard(models.Model):
+    """Диапазон id получателей промо (start_id, end_id], который рассылает одна реплика бота.
+
+    Шарды создает бот при старте рассылки. Реплика берет шард в аренду и продлевает ее
+    после каждого батча, аренду упавшей реплики по истечении забирает другая.
+    """
+    promo = models.ForeignKey(Promo, on_delete=models.CASCADE, related_name='shards')
+    start_id = models.BigIntegerField()
+    end_id = models.BigIntegerField(blank=True, null=True, help_text='Пусто - без верхней границы')
+    last_sent_user_id = models.BigIntegerField(
+        blank=True,
+        null=True,
+        help_text='Чекпоинт: id последнего обработанного пользователя, с него продолжится прерванная рассылка',
+    )
+    lease_owner = models.CharField(max_length=128, blank=True, null=True)
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+    sent = models.PositiveIntegerField(default=0, db_default=0)
+    failed = models.PositiveIntegerField(default=0, db_default=0)
+    done_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['promo', 'start_id'], name='promo_shard_start_unique'),
+        ]
+
+
+class Order(models.Model):
+    class Status(models.TextChoices):
+        PAID = 'paid', 'Оплачено'
+        REFUNDED = 'refunded', 'Возврат средств'
+
+    # Идемпотентность: повторная обработка одного платежа не создаст второй заказ
+    provider_payment_charge_id = models.CharField(max_length=255, unique=True)
+    telegram_payment_charge_id = models.CharField(max_length=255, blank=True, null=True)
+    user_id = models.BigIntegerField(db_index=True)
+    client_username = models.CharField(max_length=128, blank=True, null=True)
+    paid_amount = models.DecimalField(max_digits=12, decimal_places=2)
+    currency = models.CharField(max_length=3, default='RUB')
+    fio = models.CharField(max_length=256, blank=True, null=True)
+    phone = models.CharField(max_length=64, blank=True, null=True)
+    address = models.TextField(blank=True, null=True)
+    status = models.CharField(max_length=16, choices=Status, default=Status.PAID, db_default=Status.PAID)
+    created_at = models.DateTimeField(db_default=Now(), db_index=True)
+
+    def __str__(self):
+        return f'Заказ {self.pk} от {self.client_username or self.user_id}'
+
+
+class OrderItem(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
+    # Снимок товара на момент оплаты: товар могут изменить или удалить
+    product_id = models.UUIDField()
+    name = models.CharField(max_length=120)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.PositiveIntegerField()
+
+
+class OrderStatusChange(models.Model):
+    """История смены статусов заказа."""
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='status_changes')
+    old_status = models.CharField(max_length=16, choices=Order.Status, blank=True, null=True)
+    new_status = models.CharField(max_length=16, choices=Order.Status)
+    changed_at = models.DateTimeField(db_default=Now())
+
+
+class FAQ(models.Model):
+    """Вопросы и ответы для инлайн-поиска в боте (@bot вопрос)."""
+    question = models.CharField(max_length=255)
+    answer = models.TextField()
+    position = models.PositiveIntegerField(default=0, help_text='Порядок вывода при пустом запросе')
+    # Поиск по словам с учетом морфологии, совпадение в вопросе весит больше, чем в ответе
+    search_vector = models.GeneratedField(
+        expression=(
+            SearchVector('question', weight='A', config='russian')
+            + SearchVector('answer', weight='B', config='russian')
+        ),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector']),
+        ]
+
+    def __str__(self):
+        return self.question
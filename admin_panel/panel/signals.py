@@ -0,0 +1,91 @@
+import json
+
+from django.db import connection
+from django.db.models.signals import post_delete, post_save, pre_save
+
+from .models import FAQ, Category, Product, Promo, Subcategory
+
+# Бот слушает этот канал и сбрасывает кэш каталога (bot/src/db/cache.py)
+CATALOG_CHANNEL = 'catalog_changed'
+
+# Бот сбрасывает кэш результатов инлайн-поиска по FAQ (bot/src/faq/router.py)
+FAQ_CHANNEL = 'faq_changed'
+
+# Бот переставляет запуск рассылки на start_time ближайшего промо (bot/src/tasks/promo.py)
+PROMO_CHANNEL = 'promo_changed'
+
+# Поле родителя, по которому бот кэширует списки
+CATALOG_PARENTS = {
+    Category: None,
+    Subcategory: 'category_id',
+    Product: 'subcategory_id',
+}
+
+
+def notify(channel: str, payload: dict):
+    # NOTIFY транзакционный: бот получит уведомление только после коммита
+    with connection.cursor() as cur:
+        cur.execute('SELECT pg_notify(%s, %s)', [channel, json.dumps(payload, default=str)])
+
+
+def remember_parent(sender, instance, **kwargs):
+    """Запоминает прежнего родителя, чтобы при переносе сбросить оба списка."""
+    field = CATALOG_PARENTS[sender]
+    if field and instance.pk is not None:
+        instance._old_parent_id = sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+def refresh_stats(sender, parents: set) -> set:
+    """Пересчитывает сводку веток, затронутых изменением, возвращает id затронутых категорий."""
+    if sender is Product:
+        Subcategory.objects.filter(pk__in=parents).refresh_stats()
+        categories = set(Subcategory.objects.filter(pk__in=parents).values_list('category_id', flat=True))
+    elif sender is Subcategory:
+        categories = parents
+    else:
+        return set()
+    Category.objects.filter(pk__in=categories).refresh_stats()
+    return categories
+
+
+def catalog_changed(sender, instance, **kwargs):
+    field = CATALOG_PARENTS[sender]
+    parents = set()
+    if field:
+        parents = {getattr(instance, field), getattr(instance, '_old_parent_id', None)} - {None}
+    categories = refresh_stats(sender, parents)
+
+    payload = {
+        'model': sender._meta.model_name,
+        'id': instance.pk,
+        'parents': sorted(parents),
+    }
+    if sender is Product:
+        # После удаления любая загруженная ранее копия товара устарела
+        payload['version'] = instance.version + (kwargs['signal'] is post_delete)
+        # Счетчики на кнопках категории и ее подкатегорий тоже изменились
+        payload['categories'] = sorted(categories)
+
+    notify(CATALOG_CHANNEL, payload)
+
+
+for model in CATALOG_PARENTS:
+    pre_save.connect(remember_parent, sender=model)
+    post_save.connect(catalog_changed, sender=model)
+    post_delete.connect(catalog_changed, sender=model)
+
+
+def faq_changed(sender, instance, **kwargs):
+    notify(FAQ_CHANNEL, {'id': instance.pk})
+
+
+post_save.connect(faq_changed, sender=FAQ)
+post_delete.connect(faq_changed, sender=FAQ)
+
+
+def promo_changed(sender, instance, **kwargs):
+    notify(PROMO_CHANNEL, {'id': instance.pk})
+
+
+post_save.connect(promo_changed, sender=Promo)
+post_delete.connect(promo_changed, sender=Promo)
@@ -0,0 +1,64 @@
+import asyncio
+import itertools
+from collections import Counter
+from datetime import datetime
+from typing import Any, AsyncGenerator
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import (
+    EditMessageReplyMarkup,
+    EditMessageText,
+    GetChatMember,
+    GetMe,
+    SendInvoice,
+    SendMessage,
+    SendPhoto,
+    TelegramMethod,
+)
+from aiogram.types import Chat, ChatMemberMember, Message, User
+
+
+class FakeSession(BaseSession):
+    """Сессия бота, которая не ходит в Telegram, а сразу возвращает правдоподобный ответ.
+
+    latency имитирует время ответа Bot API; по умолчанию 0, чтобы мерить только сам бот.
+    """
+
+    def __init__(self, latency: float = 0.0, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        match method:
+            case GetMe():
+                return User(id=bot.id, is_bot=True, first_name='Benchmark', username='benchmark_bot')
+            case GetChatMember(user_id=user_id):
+                return ChatMemberMember(user=User(id=user_id, is_bot=False, first_name='User'))
+            case SendMessage() | SendPhoto() | SendInvoice() | EditMessageText() | EditMessageReplyMarkup():
+                return Message(
+                    message_id=next(self._message_ids),
+                    date=datetime.now(),
+                    chat=Chat(id=int(method.chat_id or 0), type='private'),
+                )
+            case _:
+                return True
+
+    async def stream_content(
+        self,
+        url: str,
+        headers: dict[str, Any] | None = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        yield b''
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,208 @@
+"""Нагрузочный тест хэндлеров бота.
+
+Прогоняет настоящие роутеры через Dispatcher.feed_update: N пользователей одновременно
+ходят по каталогу, ищут товары и FAQ, меняют корзину и часть из них оплачивает заказ.
+Запросы в Telegram перехватывает FakeSession, база - настоящая.
+
+Запуск из каталога bot/ на отдельной базе с примененными миграциями админки:
+    POSTGRES_CONNINFO='dbname=bench ...' python benchmarks/load_test.py --seed --users 200 --iterations 5
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from uuid import uuid4
+
+# Бот не должен получить настоящий токен: запросы перехватываются, но лучше не рисковать
+os.environ['BOT_TOKEN'] = '42:BENCHMARK'
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+from aiogram.dispatcher.event.bases import UNHANDLED  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import main  # noqa: E402
+from config import Container, bot, dp  # noqa: E402
+from db.config import POSTGRES_CONNINFO  # noqa: E402
+from fake_session import FakeSession  # noqa: E402
+from seed import BASE_USER_ID, CHARGE_PREFIX, load_catalog, seed  # noqa: E402
+
+
+class LoadTest:
+    def __init__(self, catalog: list[tuple[int, int, str, str]], checkout_ratio: float = 0.3):
+        self.catalog = catalog
+        self.checkout_ratio = checkout_ratio
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: Counter[str] = Counter()
+        self.unhandled: Counter[str] = Counter()
+        self._ids = itertools.count(1)
+
+    # Апдейты
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        return {
+            'message_id': next(self._ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            **fields,
+        }
+
+    def message(self, user_id: int, text: str | None = None, **fields) -> dict:
+        if text is not None:
+            fields['text'] = text
+        return {'message': self._message(user_id, **fields)}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        # Сообщение с кнопкой, на которую нажал пользователь
+        message = self._message(user_id, text='benchmark', reply_markup={'inline_keyboard': []})
+        message['from'] = {'id': bot.id, 'is_bot': True, 'first_name': 'Benchmark'}
+        return {
+            'callback_query': {
+                'id': str(next(self._ids)),
+                'from': self._user(user_id),
+                'chat_instance': 'benchmark',
+                'data': data,
+                'message': message,
+            },
+        }
+
+    def inline(self, user_id: int, query: str) -> dict:
+        return {'inline_query': {'id': str(next(self._ids)), 'from': self._user(user_id), 'query': query, 'offset': ''}}
+
+    def payment(self, user_id: int) -> dict:
+        return self.message(user_id, successful_payment={
+            'currency': 'RUB',
+            'total_amount': 100_00,
+            'invoice_payload': 'benchmark',
+            'telegram_payment_charge_id': f'{CHARGE_PREFIX}{uuid4()}',
+            'provider_payment_charge_id': f'{CHARGE_PREFIX}{uuid4()}',
+        })
+
+    async def feed(self, handler: str, payload: dict) -> None:
+        # Апдейт сразу привязывается к боту, как при разборе вебхука, иначе feed_update пересоберет его через JSON
+        update = Update.model_validate({'update_id': next(self._ids), **payload}, context={'bot': bot})
+        started = time.perf_counter()
+        try:
+            result = await dp.feed_update(bot, update)
+        except Exception:
+            if not self.errors[handler]:
+                logging.exception('Ошибка в %s', handler)
+            self.errors[handler] += 1
+        else:
+            if result is UNHANDLED:
+                self.unhandled[handler] += 1
+        self.latencies[handler].append(time.perf_counter() - started)
+
+    # Сценарий
+
+    async def session(self, user_id: int) -> None:
+        category_id, subcategory_id, product_id, name = random.choice(self.catalog)
+
+        await self.feed('main.command_start_handler', self.message(user_id, '/start'))
+        await self.feed('products.catalog_handler', self.message(user_id, 'Каталог'))
+        await self.feed('products.subcategories', self.callback(user_id, f'category_{category_id}'))
+        await self.feed('products.products', self.callback(user_id, f'subcategory_{subcategory_id}'))
+        await self.feed('products.product_detail_handler', self.callback(user_id, f'product_{product_id}'))
+        await self.feed('products.cart_handler', self.callback(user_id, f'product-cart_add_{product_id}'))
+        await self.feed('products.cart_handler', self.callback(user_id, f'product-cart_plus_{product_id}'))
+        await self.feed('products.inline_product_search', self.inline(user_id, f'товар {name.split()[0][:4]}'))
+        await self.feed('faq.inline_faq', self.inline(user_id, random.choice(['как', 'заказ', 'доставка', ''])))
+        await self.feed('cart.cart_handler', self.message(user_id, 'Корзина'))
+        await self.feed('cart.cart_edit_handler', self.callback(user_id, 'edit_cart'))
+
+        if random.random() >= self.checkout_ratio:
+            await self.feed('cart.cart_delete_handler', self.callback(user_id, f'cart-delete_{product_id}'))
+            return
+
+        await self.feed('cart.order_process_handler', self.callback(user_id, 'order_process'))
+        await self.feed('cart.delivery_fio_handler', self.message(user_id, 'Иванов Иван Иванович'))
+        await self.feed('cart.delivery_phone_handler', self.message(user_id, '+79990000000'))
+        await self.feed('cart.delivery_address_handler', self.message(user_id, 'Москва, пункт СДЭК 1'))
+        await self.feed('cart.process_buy_handler', self.callback(user_id, 'checkout'))
+        await self.feed('cart.process_payment', self.payment(user_id))
+
+    async def user(self, user_id: int, iterations: int) -> None:
+        for _ in range(iterations):
+            await self.session(user_id)
+
+    # Отчет
+
+    def report(self, elapsed: float) -> str:
+        total = sum(len(values) for values in self.latencies.values())
+        lines = [
+            f'{total} апдейтов за {elapsed:.2f} с: {total / elapsed:.0f} апд./с',
+            '',
+            f'{"хэндлер":<36} {"апдейтов":>9} {"ошибок":>7} {"p50, мс":>9} {"p95, мс":>9} {"p99, мс":>9}',
+        ]
+        for handler, values in self.latencies.items():
+            if len(values) > 1:
+                percentiles = statistics.quantiles(values, n=100, method='inclusive')
+                p50, p95, p99 = percentiles[49], percentiles[94], percentiles[98]
+            else:
+                p50 = p95 = p99 = values[0]
+            errors = self.errors[handler] + self.unhandled[handler]
+            lines.append(
+                f'{handler:<36} {len(values):>9} {errors:>7} {p50 * 1000:>9.2f} {p95 * 1000:>9.2f} {p99 * 1000:>9.2f}'
+            )
+        return '\n'.join(lines)
+
+
+async def on_startup(dispatcher) -> None:
+    # Без сервера метрик, слушателя, планировщика промо и загрузки всех пользователей:
+    # они искажают замеры и могут конфликтовать с запущенным ботом
+    await main.start_handler_services(dispatcher, Container())
+
+
+async def run(args: argparse.Namespace) -> None:
+    session = FakeSession(latency=args.latency / 1000)
+    bot.session = session
+    random.seed(args.random_seed)
+
+    if args.seed:
+        await seed(POSTGRES_CONNINFO, args.categories, args.subcategories, args.products, random_seed=args.random_seed)
+    catalog = await load_catalog(POSTGRES_CONNINFO)
+    if not catalog:
+        sys.exit('Синтетический каталог не найден, запустите с --seed')
+
+    main.setup_dispatcher(startup=on_startup, shutdown=main.stop_handler_services)
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot])
+    test = LoadTest(catalog, args.checkout_ratio)
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(test.user(BASE_USER_ID + i, args.iterations) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot])
+
+    print(test.report(elapsed))
+    print('\nВызовы Bot API:', ', '.join(f'{name}={count}' for name, count in session.calls.most_common()))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100, help='одновременных пользователей')
+    parser.add_argument('--iterations', type=int, default=5, help='сценариев на пользователя')
+    parser.add_argument('--checkout-ratio', type=float, default=0.3, help='доля сценариев с оплатой')
+    parser.add_argument('--latency', type=float, default=0.0, help='имитация времени ответа Bot API, мс')
+    parser.add_argument('--seed', action='store_true', help='пересоздать синтетический каталог')
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--subcategories', type=int, default=10)
+    parser.add_argument('--products', type=int, default=50, help='товаров в подкатегории')
+    parser.add_argument('--random-seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,86 @@
+"""Микробенчмарк разбора строк товаров: dict_row + pydantic против class_row + slotted dataclass.
+
+Строки генерируются в памяти в том виде, в каком их отдает psycopg (уже типизированные значения),
+а фабрики строк повторяют dict_row и class_row из psycopg.rows, поэтому база не нужна.
+
+    python benchmarks/row_mapping.py --rows 5000
+"""
+import argparse
+import gc
+import sys
+import timeit
+import tracemalloc
+from decimal import Decimal
+from pathlib import Path
+from uuid import UUID, uuid4
+
+from pydantic import BaseModel, ConfigDict
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+from db.models import Product  # noqa: E402
+
+COLUMNS = ('id', 'name', 'description', 'price', 'image', 'version')
+
+
+class PydanticProduct(BaseModel):
+    # Прежняя модель товара
+    model_config = ConfigDict(frozen=True)
+
+    id: UUID
+    name: str
+    description: str
+    price: Decimal
+    image: str
+    version: int
+
+
+def make_rows(count: int) -> list[tuple]:
+    return [
+        (uuid4(), f'Товар {i}', 'Описание товара ' * 10, Decimal('1299.90'), 'https://example.com/image.png', 1)
+        for i in range(count)
+    ]
+
+
+def via_pydantic(rows: list[tuple]) -> list:
+    # dict_row + Product.model_validate
+    return [PydanticProduct.model_validate(dict(zip(COLUMNS, values))) for values in rows]
+
+
+def via_dataclass(rows: list[tuple]) -> list:
+    # class_row(Product)
+    return [Product(**dict(zip(COLUMNS, values))) for values in rows]
+
+
+def measure_memory(mapper, rows: list[tuple]) -> tuple[int, int]:
+    """(байт на удерживаемую строку, пиковое выделение) для списка результатов."""
+    gc.collect()
+    tracemalloc.start()
+    result = mapper(rows)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained // len(rows), peak
+
+
+def main(args: argparse.Namespace) -> None:
+    rows = make_rows(args.rows)
+    print(f'{args.rows} строк, лучшее из {args.repeat} повторов')
+    print(f'{"способ":<22} {"мкс/строка":>11} {"байт/строка":>12} {"пик, КБ":>9}')
+
+    results = {}
+    for name, mapper in [('dict_row + pydantic', via_pydantic), ('class_row + dataclass', via_dataclass)]:
+        seconds = min(timeit.repeat(lambda: mapper(rows), number=1, repeat=args.repeat))
+        per_row_bytes, peak = measure_memory(mapper, rows)
+        results[name] = seconds
+        print(f'{name:<22} {seconds / args.rows * 1e6:>11.2f} {per_row_bytes:>12} {peak / 1024:>9.0f}')
+
+    speedup = results['dict_row + pydantic'] / results['class_row + dataclass']
+    print(f'\nclass_row быстрее в {speedup:.1f} раза')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000, help='строк в выборке (большая подкатегория)')
+    parser.add_argument('--repeat', type=int, default=7)
+    main(parser.parse_args())
@@ -0,0 +1,144 @@
+import random
+from decimal import Decimal
+from uuid import uuid4
+
+import psycopg
+
+# Все синтетические данные помечены, чтобы их можно было найти и удалить
+SLUG_PREFIX = 'bench-'
+FAQ_PREFIX = '[bench] '
+# Платежи нагрузочного теста (provider_payment_charge_id)
+CHARGE_PREFIX = 'bench-'
+# id синтетических пользователей, чтобы они не пересекались с настоящими
+BASE_USER_ID = 9_000_000_000
+# FSM-ключи бота с токеном 42:BENCHMARK
+FSM_KEY_PREFIX = 'fsm:42:'
+
+WORDS = [
+    'чай', 'кофе', 'кружка', 'термос', 'набор', 'подарок', 'зеленый', 'черный', 'травяной', 'молотый',
+    'зерновой', 'фарфоровый', 'стеклянный', 'большой', 'малый', 'классический', 'премиум', 'летний',
+]
+
+FAQ_QUESTIONS = [
+    'Как оформить заказ?', 'Как оплатить заказ?', 'Сколько стоит доставка?', 'Как вернуть товар?',
+    'Где мой заказ?', 'Как изменить адрес доставки?', 'Можно ли отменить заказ?', 'Как связаться с поддержкой?',
+]
+
+
+def random_name(rng: random.Random, words: int = 3) -> str:
+    return ' '.join(rng.sample(WORDS, words)).capitalize()
+
+
+async def clear(conn: psycopg.AsyncConnection) -> None:
+    """Удаляет синтетические данные (каскадов на уровне базы нет, поэтому по таблицам)."""
+    orders = 'SELECT id FROM panel_order WHERE provider_payment_charge_id LIKE %s'
+    await conn.execute(f'DELETE FROM panel_orderitem WHERE order_id IN ({orders})', (f'{CHARGE_PREFIX}%',))
+    await conn.execute(f'DELETE FROM panel_orderstatuschange WHERE order_id IN ({orders})', (f'{CHARGE_PREFIX}%',))
+    await conn.execute('DELETE FROM panel_order WHERE provider_payment_charge_id LIKE %s', (f'{CHARGE_PREFIX}%',))
+    await conn.execute('DELETE FROM panel_userbot WHERE id >= %s', (BASE_USER_ID,))
+    await conn.execute('DELETE FROM panel_fsmstate WHERE key LIKE %s', (f'{FSM_KEY_PREFIX}%',))
+    await conn.execute('''
+        DELETE FROM panel_product
+        WHERE subcategory_id IN (SELECT id FROM panel_subcategory WHERE slug LIKE %s)
+    ''', (f'{SLUG_PREFIX}%',))
+    await conn.execute('DELETE FROM panel_subcategory WHERE slug LIKE %s', (f'{SLUG_PREFIX}%',))
+    await conn.execute('DELETE FROM panel_category WHERE slug LIKE %s', (f'{SLUG_PREFIX}%',))
+    await conn.execute('DELETE FROM panel_faq WHERE question LIKE %s', (f'{FAQ_PREFIX}%',))
+
+
+async def refresh_stats(conn: psycopg.AsyncConnection) -> None:
+    """Сводка по синтетическим веткам каталога, как после manage.py refresh_catalog_stats.
+
+    Данные вставляются в обход админки, а бот показывает только непустые ветки.
+    """
+    await conn.execute('''
+        UPDATE panel_subcategory s
+        SET product_count = p.count, min_price = p.min_price, max_price = p.max_price
+        FROM (
+            SELECT subcategory_id, count(*), min(price) AS min_price, max(price) AS max_price
+            FROM panel_product GROUP BY subcategory_id
+        ) p
+        WHERE p.subcategory_id = s.id AND s.slug LIKE %s
+    ''', (f'{SLUG_PREFIX}%',))
+    await conn.execute('''
+        UPDATE panel_category c
+        SET product_count = s.count, min_price = s.min_price, max_price = s.max_price
+        FROM (
+            SELECT category_id, sum(product_count) AS count, min(min_price) AS min_price, max(max_price) AS max_price
+            FROM panel_subcategory GROUP BY category_id
+        ) s
+        WHERE s.category_id = c.id AND c.slug LIKE %s
+    ''', (f'{SLUG_PREFIX}%',))
+
+
+async def seed(
+    conninfo: str,
+    categories: int = 20,
+    subcategories: int = 10,
+    products: int = 50,
+    faq: int = 200,
+    random_seed: int = 0,
+) -> None:
+    """Наполняет базу синтетическим каталогом: categories * subcategories * products товаров."""
+    rng = random.Random(random_seed)
+    async with await psycopg.AsyncConnection.connect(conninfo) as conn:
+        await clear(conn)
+        async with conn.cursor() as cur:
+            for i in range(categories):
+                await cur.execute(
+                    'INSERT INTO panel_category(name, slug) VALUES (%s, %s) RETURNING id',
+                    (f'{random_name(rng, 2)} {i}', f'{SLUG_PREFIX}{i}'),
+                )
+                (category_id,) = await cur.fetchone()
+
+                for j in range(subcategories):
+                    await cur.execute(
+                        'INSERT INTO panel_subcategory(name, slug, category_id) VALUES (%s, %s, %s) RETURNING id',
+                        (f'{random_name(rng, 2)} {j}', f'{SLUG_PREFIX}{i}-{j}', category_id),
+                    )
+                    (subcategory_id,) = await cur.fetchone()
+
+                    await cur.executemany(
+                        '''
+                        INSERT INTO panel_product(id, name, description, price, subcategory_id, image, version)
+                        VALUES (%s, %s, %s, %s, %s, %s, 1)
+                        ''',
+                        [
+                            (
+                                uuid4(),
+                                random_name(rng),
+                                ' '.join(rng.choices(WORDS, k=20)),
+                                Decimal(rng.randrange(100, 100_000)) / 100,
+                                subcategory_id,
+                                'https://example.com/benchmark.png',
+                            )
+                            for _ in range(products)
+                        ],
+                    )
+
+            await refresh_stats(conn)
+
+            await cur.executemany(
+                'INSERT INTO panel_faq(question, answer, position) VALUES (%s, %s, %s)',
+                [
+                    (
+                        f'{FAQ_PREFIX}{rng.choice(FAQ_QUESTIONS)} {random_name(rng, 2)}',
+                        ' '.join(rng.choices(WORDS, k=30)),
+                        i,
+                    )
+                    for i in range(faq)
+                ],
+            )
+
+
+async def load_catalog(conninfo: str) -> list[tuple[int, int, str, str]]:
+    """(category_id, subcategory_id, product_id, название) всех синтетических товаров."""
+    async with await psycopg.AsyncConnection.connect(conninfo) as conn:
+        cur = await conn.execute('''
+            SELECT c.id, s.id, p.id::text, p.name
+            FROM panel_product p
+            JOIN panel_subcategory s ON s.id = p.subcategory_id
+            JOIN panel_category c ON c.id = s.category_id
+            WHERE c.slug LIKE %s
+        ''', (f'{SLUG_PREFIX}%',))
+        return await cur.fetchall()
@@ -27,15 +27,33 @@ class Cart:
         if product_id in self.__cart:
             quantity = self.__cart[product_id]['quantity']
             if quantity <= 1:
-                self.delete(product_id)
+                self.delete(product)
             else:
                 self.__cart[product_id]['quantity'] -= 1
 
-    def delete(self, product: Product) -> None:
-        product_id = str(product.id)
+    def delete(self, product: Product | str) -> None:
+        product_id = str(product.id) if isinstance(product, Product) else product
         if product_id in self.__cart:
             del self.__cart[product_id]
 
+    def refresh(self, products: dict[str, Product]) -> tuple[list[str], list[str]]:
+        """Сверяет корзину с актуальными товарами из базы.
+
+        Обновляет названия и цены, убирает товары, которых больше нет в продаже.
+        Возвращает названия товаров с изменившейся ценой и удаленных товаров.
+        """
+        changed, removed = [], []
+        for product_id, item in list(self.__cart.items()):
+            product = products.get(product_id)
+            if product is None:
+                removed.append(item['name'])
+                del self.__cart[product_id]
+                continue
+            if Decimal(item['price']) != product.price:
+                changed.append(product.name)
+            item['name'], item['price'] = product.name, str(product.price)
+        return changed, removed
+
     def clear(self):
         self.__cart = self.__storage[self.__storage_key] = {}
 
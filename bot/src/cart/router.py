@@ -1,5 +1,6 @@
 import logging
 from decimal import Decimal
+from typing import AsyncContextManager
 
 from aiogram import F, Router, types
 from aiogram.filters import StateFilter, or_f
@@ -7,14 +8,47 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import CallbackQuery, Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardButton
+from dependency_injector.wiring import Provide, inject
 
-from config import PAYMASTER_TOKEN, bot
-from utils import save_order, update_order_on_refund
+from config import PAYMASTER_TOKEN, Container, bot
+from db.models import Order, OrderItem
+from db.repository import Repository
+from tasks.orders import OrderPaid, OrderRefunded, OrderWriter
 
 from .cart import Cart
 
 router = Router()
 
+EMPTY_CART_TEXT = 'Ваша корзина пуста. Перейдите в каталог для выбора товаров'
+
+
+@inject
+async def refresh_cart(
+    cart: Cart,
+    repository: AsyncContextManager[Repository] = Provide[Container.repository],
+) -> str | None:
+    """Сверяет цены и наличие всех товаров корзины одним запросом.
+
+    Возвращает текст для пользователя, если корзина изменилась.
+    """
+    if not cart:
+        return None
+
+    async with repository as repo:
+        products = await repo.get_products_by_ids(cart.get_items_id())
+
+    changed, removed = cart.refresh(products)
+    if not changed and not removed:
+        return None
+
+    await cart.save()
+    lines = []
+    if changed:
+        lines.append('Изменилась цена: ' + ', '.join(changed))
+    if removed:
+        lines.append('Больше нет в продаже: ' + ', '.join(removed))
+    return '\n'.join(lines)
+
 
 @router.message(F.text.lower() == 'корзина')
 async def cart_handler(
@@ -22,11 +56,15 @@ async def cart_handler(
     state: FSMContext,
 ) -> None:
     cart = await Cart().init(state)
+    notice = await refresh_cart(cart)
 
     builder = InlineKeyboardBuilder()
 
+    if notice:
+        await message.answer(notice)
+
     if not cart:
-        await message.answer("Ваша корзина пуста. Перейдите в каталог для выбора товаров")
+        await message.answer(EMPTY_CART_TEXT)
         return
 
     for product_id, product_data in cart:
@@ -86,13 +124,13 @@ async def cart_delete_handler(callback: CallbackQuery, state: FSMContext):
     if cart:
         text = 'Удалите необходимые товары'
     else:
-        text = 'Ваша корзина пуста. Перейдите в каталог для выбора товаров'
+        text = EMPTY_CART_TEXT
 
     await callback.message.edit_text(text, reply_markup=builder.as_markup())
     await callback.answer()
 
 
-class Order(StatesGroup):
+class OrderForm(StatesGroup):
     fio = State()
     phone = State()
     address = State()
@@ -106,10 +144,10 @@ async def order_process_handler(
 ) -> None:
     await callback.message.answer('Пожалуйста, введите ФИО получателя полностью')
     await callback.answer()
-    await state.set_state(Order.fio)
+    await state.set_state(OrderForm.fio)
 
 
-@router.message(Order.fio)
+@router.message(OrderForm.fio)
 async def delivery_fio_handler(
     message: Message,
     state: FSMContext,
@@ -120,10 +158,10 @@ async def delivery_fio_handler(
         f'ФИО получателя: {message.text}\n'
         'Введите номер телефона получателя',
     )
-    await state.set_state(Order.phone)
+    await state.set_state(OrderForm.phone)
 
 
-@router.message(Order.phone)
+@router.message(OrderForm.phone)
 async def delivery_phone_handler(
     message: Message,
     state: FSMContext,
@@ -135,10 +173,10 @@ async def delivery_phone_handler(
         f'Номер телефона: {message.text}\n'
         'Введите адрес пункта СДЭК',
     )
-    await state.set_state(Order.address)
+    await state.set_state(OrderForm.address)
 
 
-@router.message(Order.address)
+@router.message(OrderForm.address)
 async def delivery_address_handler(
     message: Message,
     state: FSMContext,
@@ -160,25 +198,34 @@ async def delivery_address_handler(
         reply_markup=builder.as_markup(),
     )
 
-    await state.set_state(Order.checkout)
+    await state.set_state(OrderForm.checkout)
 
 
 @router.callback_query(F.data.startswith("checkout"))
 async def process_buy_handler(callback: CallbackQuery, state: FSMContext):
 
     cart = await Cart().init(state)
+    # Цены в корзине скопированы при добавлении товара, счет выставляется по текущим
+    notice = await refresh_cart(cart)
+
+    await callback.answer()
+
+    if notice:
+        await callback.message.answer(notice)
+
+    if not cart:
+        await callback.message.answer(EMPTY_CART_TEXT)
+        return
 
     prices = [
         types.LabeledPrice(
             label=product['name'],
-            amount=str(Decimal(product['price']) * product['quantity'] * 100)
+            amount=int(Decimal(product['price']) * product['quantity'] * 100)
         )
         for _, product in cart
     ]
     desc = 'Для оплаты нажмите кнопку Оплатить'
 
-    await callback.answer()
-
     await bot.send_invoice(
         chat_id=callback.from_user.id,
         title="Оплата заказа",
@@ -227,32 +274,48 @@ async def process_pre_checkout(pre_checkout_query: types.PreCheckoutQuery):
 
 
 @router.message(lambda message: message.successful_payment is not None)
-async def process_payment(message: types.Message, state: FSMContext):
+@inject
+async def process_payment(
+    message: types.Message,
+    state: FSMContext,
+    order_writer: OrderWriter = Provide[Container.order_writer],
+):
     user_data = await state.get_data()
     cart = await Cart().init(state)
     payment = message.successful_payment
 
-    # Сохраняем заказ в excel таблицу
-    save_order(
-        client_username=message.from_user.username,
-        products=list(cart),
+    order = Order(
         provider_payment_charge_id=payment.provider_payment_charge_id,
-        paid_amount=payment.total_amount / 100,
+        telegram_payment_charge_id=payment.telegram_payment_charge_id,
+        user_id=message.from_user.id,
+        client_username=message.from_user.username,
+        paid_amount=Decimal(payment.total_amount) / 100,
+        currency=payment.currency,
         fio=user_data.get('fio'),
         phone=user_data.get('phone'),
         address=user_data.get('address'),
+        items=[
+            OrderItem(product_id=product_id, name=item['name'], price=item['price'], quantity=item['quantity'])
+            for product_id, item in cart
+        ],
     )
-    logging.info('Новый заказ от %s', message.from_user.username)
+
+    # Запись в базу идет в фоне, пользователь получает ответ сразу
+    order_writer.submit(OrderPaid(order))
 
     await message.answer("✅ Платеж успешно завершен! Спасибо!")
 
 
 @router.message(lambda message: message.refunded_payment is not None)
-async def process_refunded_payment(message: types.Message):
+@inject
+async def process_refunded_payment(
+    message: types.Message,
+    order_writer: OrderWriter = Provide[Container.order_writer],
+):
     refund = message.refunded_payment
 
     # При возврате средств изменяем статус заказа
-    update_order_on_refund(refund.provider_payment_charge_id)
+    order_writer.submit(OrderRefunded(refund.provider_payment_charge_id))
     logging.info('Возврат средств от %s', message.from_user.username)
 
     await message.answer(
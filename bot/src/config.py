@@ -1,15 +1,77 @@
+import os
+import socket
 from os import getenv
 
 from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.memory import SimpleEventIsolation
 from dependency_injector import containers, providers
 
-from db.config import init_pool, get_repository
+from db.cache import ProductCache, TTLCache
+from db.config import (
+    CATALOG_CACHE_SIZE,
+    CATALOG_CACHE_TTL,
+    FSM_CACHE_TTL,
+    POSTGRES_CONNINFO,
+    PRODUCT_CACHE_SIZE,
+    get_repository,
+    init_pool,
+)
+from db.fsm import PostgresStorage
+from db.listener import PgListener
+from subscriptions import SubscriptionChecker
+from tasks.orders import OrderWriter
+from tasks.users import UserRegistrar
 
 TOKEN = getenv('BOT_TOKEN')
 PAYMASTER_TOKEN = getenv('PAYMASTER_TOKEN')
 
+# Глобальный лимит Telegram ~30 сообщений в секунду, оставляем небольшой запас.
+# Скорость задается на бота: реплики делят ее поровну по числу держащих аренду шардов промо
+BROADCAST_RATE = float(getenv('BROADCAST_RATE', 28))
+BROADCAST_WORKERS = int(getenv('BROADCAST_WORKERS', 16))
+PROMO_BATCH_SIZE = int(getenv('PROMO_BATCH_SIZE', 1000))
+# Служебный чат, куда обложка промо загружается до начала рассылки
+PROMO_PREVIEW_CHAT_ID = int(getenv('PROMO_PREVIEW_CHAT_ID')) if getenv('PROMO_PREVIEW_CHAT_ID') else None
+# Через сколько секунд повторить рассылку, прерванную ошибкой
+PROMO_RETRY_DELAY = float(getenv('PROMO_RETRY_DELAY', 60))
+# Рассылку ведут все запущенные реплики, каждая берет в аренду шарды аудитории
+# примерно по PROMO_SHARD_SIZE пользователей.
+# Аренда продлевается фоновой задачей каждые PROMO_SHARD_LEASE / 3 секунд и во время отправки батча;
+# шарды упавшей реплики заберут остальные по ее истечении
+PROMO_SHARD_SIZE = int(getenv('PROMO_SHARD_SIZE', 10_000))
+PROMO_SHARD_LEASE = float(getenv('PROMO_SHARD_LEASE', 180))
+REPLICA_ID = getenv('REPLICA_ID') or f'{socket.gethostname()}:{os.getpid()}'
+
+# polling - для локальной разработки, webhook - для продакшена за nginx
+BOT_MODE = getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = getenv('WEBHOOK_URL', '')  # публичный https-адрес, например https://example.com
+WEBHOOK_PATH = getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_WORKERS = int(getenv('WEBHOOK_WORKERS', 4))
+# Эндпоинт /metrics для Prometheus, у воркера вебхука порт METRICS_PORT + номер воркера; 0 - выключен
+METRICS_PORT = int(getenv('METRICS_PORT', 9100))
+
+FAQ_PAGE_SIZE = int(getenv('FAQ_PAGE_SIZE', 20))
+FAQ_CACHE_SIZE = int(getenv('FAQ_CACHE_SIZE', 512))
+# Сколько секунд Telegram может отвечать на тот же инлайн-запрос из своего кэша, не обращаясь к боту
+FAQ_INLINE_CACHE_TIME = int(getenv('FAQ_INLINE_CACHE_TIME', 300))
+PRODUCT_SEARCH_PAGE_SIZE = int(getenv('PRODUCT_SEARCH_PAGE_SIZE', 20))
+# Цены могут меняться, поэтому Telegram держит результаты поиска товаров недолго
+PRODUCT_INLINE_CACHE_TIME = int(getenv('PRODUCT_INLINE_CACHE_TIME', 60))
+
+# Каналы, подписка на которые обязательна: id (-100...) или @username через запятую
+SUBSCRIBE_TO = [
+    int(channel) if channel.lstrip('-').isdigit() else channel
+    for channel in (channel.strip() for channel in getenv('SUBSCRIBE_TO', '').split(','))
+    if channel
+]
+SUBSCRIPTION_CACHE_TTL = float(getenv('SUBSCRIPTION_CACHE_TTL', 300))
+
 bot = Bot(token=TOKEN)
-dp = Dispatcher()
+# Апдейты одного пользователя обрабатываются по очереди: FSM-хранилище перезаписывает запись целиком
+dp = Dispatcher(events_isolation=SimpleEventIsolation())
 
 
 class Container(containers.DeclarativeContainer):
@@ -18,12 +80,63 @@ class Container(containers.DeclarativeContainer):
             'main',
             'tasks.promo',
             'products.router',
+            'cart.router',
+            'faq.router',
         ],
     )
 
     pool = providers.Resource(init_pool)
 
+    catalog_cache = providers.Singleton(
+        TTLCache,
+        maxsize=CATALOG_CACHE_SIZE,
+        ttl=CATALOG_CACHE_TTL,
+    )
+
+    product_cache = providers.Singleton(
+        ProductCache,
+        maxsize=PRODUCT_CACHE_SIZE,
+        ttl=CATALOG_CACHE_TTL,
+    )
+
+    # Готовые результаты инлайн-поиска по FAQ
+    faq_cache = providers.Singleton(
+        TTLCache,
+        maxsize=FAQ_CACHE_SIZE,
+        ttl=CATALOG_CACHE_TTL,
+    )
+
+    listener = providers.Singleton(
+        PgListener,
+        conninfo=POSTGRES_CONNINFO,
+    )
+
     repository = providers.Factory(
         get_repository,
         pool=pool,
+        cache=catalog_cache,
+        product_cache=product_cache,
+    )
+
+    fsm_storage = providers.Singleton(
+        PostgresStorage,
+        pool=pool,
+        cache_ttl=FSM_CACHE_TTL,
+    )
+
+    order_writer = providers.Singleton(
+        OrderWriter,
+        repository=repository.provider,
+    )
+
+    user_registrar = providers.Singleton(
+        UserRegistrar,
+        repository=repository.provider,
+    )
+
+    subscription_checker = providers.Singleton(
+        SubscriptionChecker,
+        bot=bot,
+        channels=SUBSCRIBE_TO,
+        ttl=SUBSCRIPTION_CACHE_TTL,
     )
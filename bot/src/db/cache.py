@@ -0,0 +1,226 @@
+import inspect
+import time
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from typing import Any, Awaitable, Callable, Hashable
+
+from psycopg_pool import AsyncConnectionPool
+
+from metrics import TimedRepository, observe_repository
+
+from .models import Product
+from .repository import PageKey, RawSQLRepository
+
+CATALOG_CHANNEL = 'catalog_changed'
+FAQ_CHANNEL = 'faq_changed'
+
+_MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш с ограничением по размеру и времени жизни записей.
+
+    Ключи - кортежи, что позволяет сбрасывать сразу группу записей по префиксу.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        self._generation += 1
+        self._data.pop(key, None)
+
+    def invalidate(self, prefix: tuple) -> None:
+        self._generation += 1
+        for key in [key for key in self._data if key[:len(prefix)] == prefix]:
+            del self._data[key]
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._data.clear()
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            generation = self._generation
+            value = await loader()
+            # Пока шел запрос, кэш могли инвалидировать, и загруженные данные уже устарели
+            if generation == self._generation:
+                self.set(key, value)
+        return value
+
+    @property
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ProductCache(TTLCache):
+    """Кэш товаров по id с учетом версии строки.
+
+    Помнит последнюю версию товара из уведомлений админки и не принимает
+    копии с меньшей версией, загруженные до изменения (например, со старой ценой).
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 600.0):
+        super().__init__(maxsize, ttl)
+        self._versions: OrderedDict[str, int] = OrderedDict()
+
+    def set(self, key: str, value: Product | None) -> None:
+        # Отсутствующий товар не кэшируется: его могут вот-вот создать
+        if value is not None and value.version >= self._versions.get(key, 0):
+            super().set(key, value)
+
+    def bump(self, key: str, version: int) -> None:
+        self._versions[key] = max(version, self._versions.get(key, 0))
+        self._versions.move_to_end(key)
+        while len(self._versions) > self.maxsize:
+            self._versions.popitem(last=False)
+        self._data.pop(key, None)
+
+
+def freeze(after: PageKey | None) -> tuple | None:
+    # Ключ страницы приходит из FSM списком, а для ключа кэша нужен hashable
+    return tuple(after) if after is not None else None
+
+
+def invalidate_catalog(cache: TTLCache, product_cache: ProductCache, event: dict) -> None:
+    """Сбрасывает записи кэшей, затронутые изменением модели каталога в админке.
+
+    Вместе со списками сбрасываются и собранные из них клавиатуры (ключи ('keyboard', *prefix)).
+    """
+    # Результаты поиска зависят от любого товара и от того, привязан ли он к подкатегории
+    prefixes = [('search',)]
+    match event['model']:
+        case 'category':
+            prefixes.append(('categories',))
+            prefixes.append(('subcategories', int(event['id'])))
+        case 'subcategory':
+            # Счетчик товаров категории меняется при переносе и удалении подкатегории
+            prefixes.append(('categories',))
+            for category_id in event['parents']:
+                prefixes.append(('subcategories', int(category_id)))
+            prefixes.append(('products', int(event['id'])))
+        case 'product':
+            # Сводка на кнопках: категории, подкатегории родительских категорий и список товаров
+            prefixes.append(('categories',))
+            for category_id in event.get('categories', []):
+                prefixes.append(('subcategories', int(category_id)))
+            for subcategory_id in event['parents']:
+                prefixes.append(('products', int(subcategory_id)))
+            product_cache.bump(str(event['id']), event['version'])
+        case _:
+            cache.clear()
+            product_cache.clear()
+
+    for prefix in prefixes:
+        cache.invalidate(prefix)
+        cache.invalidate(('keyboard', *prefix))
+
+
+class CachedRepository:
+    """Кэширующий слой перед RawSQLRepository.
+
+    Соединение берется из пула только при первом обращении к базе, поэтому
+    навигация по каталогу, попавшая в кэш, обходится без запросов.
+    Некэшируемые методы проксируются в RawSQLRepository как есть.
+    """
+
+    def __init__(
+        self,
+        pool: AsyncConnectionPool,
+        cache: TTLCache,
+        product_cache: ProductCache,
+        stack: AsyncExitStack,
+    ):
+        self._pool = pool
+        self._cache = cache
+        self._product_cache = product_cache
+        self._stack = stack
+        self._raw: TimedRepository | None = None
+
+    async def _repo(self) -> RawSQLRepository:
+        if self._raw is None:
+            started = time.perf_counter()
+            conn = await self._stack.enter_async_context(self._pool.connection())
+            observe_repository('connection', time.perf_counter() - started)
+            self._raw = TimedRepository(RawSQLRepository(conn))
+        return self._raw
+
+    async def get_categories(self, limit: int, after: PageKey | None = None):
+        async def load():
+            return await (await self._repo()).get_categories(limit, after)
+        return await self._cache.get_or_load(('categories', limit, freeze(after)), load)
+
+    async def get_subcategories(self, category_id: int, limit: int, after: PageKey | None = None):
+        async def load():
+            return await (await self._repo()).get_subcategories(category_id, limit, after)
+        key = ('subcategories', int(category_id), limit, freeze(after))
+        return await self._cache.get_or_load(key, load)
+
+    async def get_products(self, subcategory_id: int, limit: int, after: PageKey | None = None):
+        async def load():
+            return await (await self._repo()).get_products(subcategory_id, limit, after)
+        key = ('products', int(subcategory_id), limit, freeze(after))
+        return await self._cache.get_or_load(key, load)
+
+    async def search_products(self, words: tuple[str, ...], limit: int, offset: int = 0):
+        async def load():
+            return await (await self._repo()).search_products(words, limit, offset)
+        return await self._cache.get_or_load(('search', words, limit, offset), load)
+
+    async def get_product_by_id(self, product_id: str) -> Product | None:
+        async def load():
+            return await (await self._repo()).get_product_by_id(product_id)
+        return await self._product_cache.get_or_load(str(product_id), load)
+
+    async def get_products_by_ids(self, product_ids) -> dict[str, Product]:
+        # Для корзины и оплаты цены всегда читаются из базы, а свежие строки обновляют кэш
+        products = await (await self._repo()).get_products_by_ids(product_ids)
+        for product_id, product in products.items():
+            self._product_cache.set(product_id, product)
+        return products
+
+    def __getattr__(self, name: str):
+        method = getattr(RawSQLRepository, name)
+
+        if inspect.isasyncgenfunction(method):
+            async def generator(*args, **kwargs):
+                repo = await self._repo()
+                async for row in getattr(repo, name)(*args, **kwargs):
+                    yield row
+            return generator
+
+        async def call(*args, **kwargs):
+            repo = await self._repo()
+            return await getattr(repo, name)(*args, **kwargs)
+        return call
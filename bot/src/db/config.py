@@ -1,29 +1,70 @@
-from contextlib import asynccontextmanager
+import logging
+from contextlib import AsyncExitStack, asynccontextmanager
 from os import getenv
 
 from psycopg_pool import AsyncConnectionPool
 
-from .repository import RawSQLRepository
+from .cache import CachedRepository, ProductCache, TTLCache
 
 POSTGRES_CONNINFO = getenv('POSTGRES_CONNINFO')
+CATALOG_CACHE_SIZE = int(getenv('CATALOG_CACHE_SIZE', 2048))
+CATALOG_CACHE_TTL = float(getenv('CATALOG_CACHE_TTL', 600))
+PRODUCT_CACHE_SIZE = int(getenv('PRODUCT_CACHE_SIZE', 4096))
+FSM_CACHE_TTL = float(getenv('FSM_CACHE_TTL', 300))
+
+
+# Размер пула задается на процесс: в режиме вебхука соединений будет WEBHOOK_WORKERS * POSTGRES_POOL_MAX_SIZE
+POSTGRES_POOL_MIN_SIZE = int(getenv('POSTGRES_POOL_MIN_SIZE', 2))
+POSTGRES_POOL_MAX_SIZE = int(getenv('POSTGRES_POOL_MAX_SIZE', 10))
+POSTGRES_POOL_TIMEOUT = float(getenv('POSTGRES_POOL_TIMEOUT', 30))
+POSTGRES_POOL_MAX_IDLE = float(getenv('POSTGRES_POOL_MAX_IDLE', 600))
+POSTGRES_POOL_MAX_LIFETIME = float(getenv('POSTGRES_POOL_MAX_LIFETIME', 3600))
+POOL_STATS_INTERVAL = int(getenv('POOL_STATS_INTERVAL', 60))
 
 
 async def init_pool():
+    """Пул открывается один раз при старте процесса и закрывается при остановке (shutdown_resources)."""
     pool = AsyncConnectionPool(
         conninfo=POSTGRES_CONNINFO,
-        min_size=1,
-        max_size=10,
+        min_size=POSTGRES_POOL_MIN_SIZE,
+        max_size=POSTGRES_POOL_MAX_SIZE,
         open=False,
-        timeout=30.0,
-        max_lifetime=3600.0,
-        max_idle=600.0,
+        timeout=POSTGRES_POOL_TIMEOUT,
+        max_lifetime=POSTGRES_POOL_MAX_LIFETIME,
+        max_idle=POSTGRES_POOL_MAX_IDLE,
+    )
+    await pool.open(wait=True)
+    yield pool
+    await pool.close()
+
+
+def report_pool_stats(pool: AsyncConnectionPool) -> dict:
+    """Пишет в лог состояние пула за интервал с прошлого вызова.
+
+    requests_waiting > 0 или растущее время ожидания значат, что хэндлеры стоят в очереди за соединением.
+    """
+    stats = pool.pop_stats()
+    queued = stats.get('requests_queued', 0)
+    report = {
+        'size': stats.get('pool_size', 0),
+        'in_use': stats.get('pool_size', 0) - stats.get('pool_available', 0),
+        'waiting': stats.get('requests_waiting', 0),
+        'requests': stats.get('requests_num', 0),
+        'queued': queued,
+        'avg_wait_ms': stats.get('requests_wait_ms', 0) / queued if queued else 0,
+        'errors': stats.get('requests_errors', 0),
+    }
+    level = logging.WARNING if report['waiting'] or report['errors'] else logging.INFO
+    logging.log(
+        level,
+        'Пул БД: соединений %(size)s, занято %(in_use)s, ждут %(waiting)s, запросов %(requests)s, '
+        'в очереди %(queued)s, среднее ожидание %(avg_wait_ms).1f мс, ошибок %(errors)s',
+        report,
     )
-    return pool
+    return report
 
 
 @asynccontextmanager
-async def get_repository(pool: AsyncConnectionPool):
-    await pool.open()
-    async with pool.connection() as conn:
-        repo = RawSQLRepository(conn)
-        yield repo
+async def get_repository(pool: AsyncConnectionPool, cache: TTLCache, product_cache: ProductCache):
+    async with AsyncExitStack() as stack:
+        yield CachedRepository(pool, cache, product_cache, stack)
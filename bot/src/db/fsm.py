@@ -0,0 +1,205 @@
+import asyncio
+import copy
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Awaitable, Callable, Mapping
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (
+    BaseEventIsolation,
+    BaseStorage,
+    DefaultKeyBuilder,
+    KeyBuilder,
+    StateType,
+    StorageKey,
+)
+from aiogram.fsm.storage.memory import SimpleEventIsolation
+from aiogram.types import TelegramObject
+from psycopg import AsyncConnection, OperationalError
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+
+from .cache import TTLCache
+
+
+@dataclass(slots=True)
+class Record:
+    state: str | None = None
+    data: dict = field(default_factory=dict)
+    dirty: bool = False
+
+    def copy(self) -> 'Record':
+        return Record(self.state, copy.deepcopy(self.data))
+
+
+# Записи, прочитанные за время обработки текущего апдейта (у каждого апдейта своя задача и контекст)
+_records: ContextVar[dict[str, Record] | None] = ContextVar('fsm_records', default=None)
+# Включается FSMFlushMiddleware: записи копятся и сохраняются одним запросом в конце апдейта
+_batching: ContextVar[bool] = ContextVar('fsm_batching', default=False)
+
+# Пространство ключей advisory-локов FSM: pg_advisory_lock(FSM_LOCK_SPACE, hashtext(key))
+FSM_LOCK_SPACE = 0x66736D
+
+
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище в таблице panel_fsmstate, переживает перезапуск бота.
+
+    Состояние и данные хранятся одной строкой и читаются одним запросом на апдейт,
+    все последующие get_state/get_data/update_data обслуживаются из памяти.
+    Локальный кэш между апдейтами работает как write-through; в режиме вебхука,
+    где апдейты приходят в разные процессы и реплики, он отключается.
+
+    Запись перезаписывает строку целиком, поэтому апдейты одного ключа должны
+    обрабатываться по очереди (events_isolation диспетчера).
+    """
+
+    def __init__(
+        self,
+        pool: AsyncConnectionPool,
+        cache_size: int = 10_000,
+        cache_ttl: float = 300.0,
+        key_builder: KeyBuilder | None = None,
+    ):
+        self._pool = pool
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+    async def _record(self, key: StorageKey) -> tuple[str, Record]:
+        records = _records.get()
+        if records is None:
+            records = {}
+            _records.set(records)
+
+        storage_key = self._key_builder.build(key)
+        if (record := records.get(storage_key)) is None:
+            cached = self._cache.get(storage_key)
+            if cached is None:
+                cached = await self._select(storage_key)
+                self._cache.set(storage_key, cached)
+            record = records[storage_key] = cached.copy()
+        return storage_key, record
+
+    async def _write(self, storage_key: str, record: Record) -> None:
+        if _batching.get():
+            record.dirty = True
+        else:
+            await self._upsert([(storage_key, record)])
+
+    async def _select(self, storage_key: str) -> Record:
+        async with self._pool.connection() as conn:
+            cur = await conn.execute('SELECT state, data FROM panel_fsmstate WHERE key = %s', (storage_key,))
+            row = await cur.fetchone()
+        return Record(*row) if row else Record()
+
+    async def _upsert(self, records: list[tuple[str, Record]]) -> None:
+        stmt = '''
+            INSERT INTO panel_fsmstate(key, state, data, updated_at)
+            VALUES (%s, %s, %s, now())
+            ON CONFLICT (key) DO UPDATE
+            SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+        '''
+        async with self._pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany(stmt, [(k, r.state, Jsonb(r.data)) for k, r in records])
+        # В общий кэш попадает только то, что уже закоммичено
+        for storage_key, record in records:
+            self._cache.set(storage_key, record.copy())
+            record.dirty = False
+
+    async def flush(self) -> None:
+        """Сохраняет записи, накопленные за время обработки апдейта."""
+        records = _records.get()
+        if not records:
+            return
+        if dirty := [(k, r) for k, r in records.items() if r.dirty]:
+            await self._upsert(dirty)
+        records.clear()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key, record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        await self._write(storage_key, record)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        _, record = await self._record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key, record = await self._record(key)
+        record.data = copy.deepcopy(dict(data))
+        await self._write(storage_key, record)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, record = await self._record(key)
+        return copy.deepcopy(record.data)
+
+    async def close(self) -> None:
+        pass
+
+
+class PostgresEventIsolation(BaseEventIsolation):
+    """Обрабатывает апдейты одного ключа FSM по очереди во всех процессах и репликах бота.
+
+    Внутри процесса апдейты ждут на asyncio.Lock, между процессами - на сессионном advisory-локе.
+    Локи берутся на отдельном соединении процесса, а не из пула хэндлеров: оно занято только
+    на время коротких pg_try_advisory_lock/pg_advisory_unlock, занятый лок опрашивается
+    раз в retry_interval секунд. При обрыве соединения локи снимаются, соединение открывается заново.
+    """
+
+    def __init__(self, conninfo: str, key_builder: KeyBuilder | None = None, retry_interval: float = 0.05):
+        self._conninfo = conninfo
+        self._conn: AsyncConnection | None = None
+        self._connecting = asyncio.Lock()
+        self._local = SimpleEventIsolation()
+        self._key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self._retry_interval = retry_interval
+
+    async def _fetch(self, query: str, params: tuple) -> Any:
+        async with self._connecting:
+            if self._conn is None or self._conn.closed:
+                self._conn = await AsyncConnection.connect(self._conninfo, autocommit=True)
+        cur = await self._conn.execute(query, params)
+        (value,) = await cur.fetchone()
+        return value
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        params = (FSM_LOCK_SPACE, self._key_builder.build(key))
+        async with self._local.lock(key):
+            while not await self._fetch('SELECT pg_try_advisory_lock(%s, hashtext(%s))', params):
+                await asyncio.sleep(self._retry_interval)
+            try:
+                yield
+            finally:
+                try:
+                    await self._fetch('SELECT pg_advisory_unlock(%s, hashtext(%s))', params)
+                except OperationalError:
+                    # С обрывом соединения сервер уже снял лок
+                    pass
+
+    async def close(self) -> None:
+        await self._local.close()
+        if self._conn is not None:
+            await self._conn.close()
+
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """Объединяет все изменения FSM за время обработки апдейта в одну запись в базу."""
+
+    def __init__(self, storage: PostgresStorage):
+        self.storage = storage
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        token = _batching.set(True)
+        try:
+            return await handler(event, data)
+        finally:
+            _batching.reset(token)
+            await self.storage.flush()
@@ -0,0 +1,61 @@
+import asyncio
+import inspect
+import json
+import logging
+from collections import defaultdict
+from typing import Callable
+
+import psycopg
+from psycopg import sql
+
+
+class PgListener:
+    """Слушает каналы Postgres (LISTEN) и раздает уведомления подписчикам.
+
+    Держит отдельное соединение вне пула. После каждого (пере)подключения вызывает
+    обработчики on_connect: уведомления, пришедшие во время разрыва, потеряны,
+    и подписчики должны сбросить то, что могло устареть.
+    """
+
+    def __init__(self, conninfo: str, reconnect_delay: float = 5.0):
+        self._conninfo = conninfo
+        self._reconnect_delay = reconnect_delay
+        self._handlers: dict[str, list[Callable]] = defaultdict(list)
+        self._on_connect: list[Callable] = []
+
+    def subscribe(self, channel: str, callback: Callable[[dict], None]) -> None:
+        self._handlers[channel].append(callback)
+
+    def on_connect(self, callback: Callable[[], None]) -> None:
+        self._on_connect.append(callback)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error('Соединение для LISTEN потеряно: %s', e)
+            await asyncio.sleep(self._reconnect_delay)
+
+    async def _listen(self) -> None:
+        async with await psycopg.AsyncConnection.connect(self._conninfo, autocommit=True) as conn:
+            for channel in self._handlers:
+                await conn.execute(sql.SQL('LISTEN {}').format(sql.Identifier(channel)))
+
+            for callback in self._on_connect:
+                await self._call(callback)
+
+            async for notify in conn.notifies():
+                for callback in self._handlers.get(notify.channel, []):
+                    try:
+                        await self._call(callback, json.loads(notify.payload or '{}'))
+                    except Exception:
+                        logging.exception('Ошибка обработки уведомления %s', notify.channel)
+
+    @staticmethod
+    async def _call(callback: Callable, *args) -> None:
+        result = callback(*args)
+        if inspect.isawaitable(result):
+            await result
@@ -1,20 +1,76 @@
+from dataclasses import dataclass
 from decimal import Decimal
 from uuid import UUID
 
 from pydantic import BaseModel
 
+# Строки каталога и промо psycopg уже вернул с нужными типами (uuid, numeric, ...),
+# поэтому они собираются в dataclass через class_row без повторной валидации.
+# pydantic остается там, где данные приходят извне: заказ собирается из апдейта Telegram.
 
-class Product(BaseModel):
+
+@dataclass(frozen=True, slots=True)
+class Product:
+    # Экземпляры разделяются между пользователями через кэш
     id: UUID
     name: str
     description: str
     price: Decimal
     image: str
+    version: int
+
+
+@dataclass(frozen=True, slots=True)
+class CatalogNode:
+    # Категория или подкатегория со сводкой по товарам ветки
+    id: int
+    name: str
+    product_count: int
+    min_price: Decimal | None = None
+    max_price: Decimal | None = None
 
 
-class Promo(BaseModel):
+@dataclass(frozen=True, slots=True)
+class FAQ:
+    id: int
+    question: str
+    answer: str
+
+
+@dataclass(slots=True)
+class Promo:
     id: int
     text: str
     cover: str
     link: str
     text_link: str
+    cover_file_id: str | None = None
+
+
+@dataclass(frozen=True, slots=True)
+class PromoShard:
+    # Получатели с id в (start_id, end_id], end_id = None - без верхней границы
+    id: int
+    start_id: int
+    end_id: int | None
+    last_sent_user_id: int | None = None
+
+
+class OrderItem(BaseModel):
+    product_id: UUID
+    name: str
+    price: Decimal
+    quantity: int
+
+
+class Order(BaseModel):
+    provider_payment_charge_id: str
+    telegram_payment_charge_id: str | None = None
+    user_id: int
+    client_username: str | None = None
+    paid_amount: Decimal
+    currency: str = 'RUB'
+    fio: str | None = None
+    phone: str | None = None
+    address: str | None = None
+    items: list[OrderItem]
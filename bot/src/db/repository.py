@@ -1,113 +1,472 @@
+import json
 import typing
 from datetime import datetime
+from uuid import UUID
 
 import psycopg
 from aiogram.types import User
-from psycopg.rows import dict_row
+from psycopg.rows import class_row, dict_row
 
-from .models import Product, Promo
+from .models import FAQ, CatalogNode, Order, Product, Promo, PromoShard
+
+
+# Ключ keyset-пагинации: (name, id) последнего элемента предыдущей страницы
+PageKey = tuple[str, int | str] | list
 
 
 class Repository(typing.Protocol):
-    async def get_categories(self, page: int = 0) -> list[tuple[int, str]]: ...
-    async def get_subcategories(self, category_id: int, page: int = 0): ...
-    async def get_products(self, subcategory_id: int, page: int = 0) -> list[Product]: ...
-    async def get_product_by_id(self, product_id: str) -> Product: ...
+    async def get_categories(self, limit: int, after: PageKey | None = None) -> tuple[list[CatalogNode], bool]: ...
+    async def get_subcategories(
+        self, category_id: int, limit: int, after: PageKey | None = None,
+    ) -> tuple[list[CatalogNode], bool]: ...
+    async def get_products(
+        self, subcategory_id: int, limit: int, after: PageKey | None = None,
+    ) -> tuple[list[Product], bool]: ...
+    async def get_product_by_id(self, product_id: str) -> Product | None: ...
+    async def get_products_by_ids(self, product_ids: typing.Iterable[str | UUID]) -> dict[str, Product]: ...
+    async def search_faq(self, words: typing.Sequence[str], limit: int, offset: int = 0) -> tuple[list[FAQ], bool]: ...
+    async def search_products(
+        self, words: typing.Sequence[str], limit: int, offset: int = 0,
+    ) -> tuple[list[Product], bool]: ...
     async def get_active_promo(self, cur_time: datetime): ...
-    async def get_users_by_batch(self): ...
-    async def add_user(self, user: User): ...
-    async def update_promo(self, promo_id: int | str, cur_time: datetime): ...
+    async def get_next_promo_time(self) -> datetime | None: ...
+    async def count_users(self, after_id: int = 0, until_id: int | None = None) -> int: ...
+    async def get_user_ids(self, after_id: int, limit: int, until_id: int | None = None) -> list[int]: ...
+    async def add_user(self, user: User) -> bool: ...
+    async def add_users(self, users: typing.Sequence[User]) -> list[int]: ...
+    async def set_promo_cover_file_id(self, promo_id: int, file_id: str): ...
+    async def plan_promo_shards(self, promo_id: int, shard_size: int) -> int: ...
+    async def claim_promo_shard(self, promo_id: int, owner: str, lease: float) -> PromoShard | None: ...
+    async def renew_promo_shard(
+        self, shard_id: int, owner: str, last_sent_user_id: int, sent: int, failed: int, lease: float,
+    ) -> bool: ...
+    async def complete_promo_shard(self, shard_id: int, owner: str) -> bool: ...
+    async def get_promo_lease_expiry(self, promo_id: int) -> datetime | None: ...
+    async def count_promo_replicas(self, promo_id: int) -> int: ...
+    async def finish_promo(self, promo_id: int, cur_time: datetime) -> bool: ...
+    async def add_order(self, order: Order) -> int | None: ...
+    async def refund_order(self, provider_payment_charge_id: str) -> int | None: ...
+    def iter_orders(self) -> typing.AsyncIterator[dict]: ...
+    async def notify(self, channel: str, payload: dict): ...
+    async def mark_update_processed(self, update_id: int) -> bool: ...
+    async def delete_processed_updates(self, before: datetime): ...
+
+
+def seek(query: str, params: list, limit: int, after: PageKey | None) -> tuple[str, list]:
+    """Дописывает к запросу keyset-условие по (name, id) и LIMIT n + 1.
+
+    Лишняя строка нужна только для того, чтобы узнать, есть ли следующая страница.
+    """
+    if after is not None:
+        query += ' AND (name, id) > (%s, %s)'
+        params = [*params, *after]
+    query += ' ORDER BY name, id LIMIT %s'
+    return query, [*params, limit + 1]
+
+
+# Пространство ключей advisory-локов рассылки: pg_advisory_xact_lock(PROMO_LOCK_SPACE, promo_id)
+PROMO_LOCK_SPACE = 0x70726F6D
+
+
+def prefix_tsquery(words: typing.Sequence[str]) -> str:
+    """Запрос для to_tsquery, в котором каждое слово ищется как префикс: чай зел -> чай:* & зел:*.
+
+    Слова должны быть уже разбиты по \\w+, тогда служебных символов tsquery в них нет.
+    """
+    return ' & '.join(f'{word}:*' for word in words)
 
 
 class RawSQLRepository:
     def __init__(self, connection: psycopg.AsyncConnection):
         self._conn = connection
 
-    async def get_categories(self, page: int = 0):
-        async with self._conn.cursor() as cur:
-            await cur.execute("SELECT id, name FROM panel_category ORDER BY name")
-            return await cur.fetchall()
+    async def get_categories(self, limit: int, after: PageKey | None = None):
+        """Непустые категории со сводкой по товарам (поля поддерживает админка)."""
+        async with self._conn.cursor(row_factory=class_row(CatalogNode)) as cur:
+            query = '''
+                SELECT id, name, product_count, min_price, max_price
+                FROM panel_category
+                WHERE product_count > 0
+            '''
+            query, params = seek(query, [], limit, after)
+            await cur.execute(query, params)
+            rows = await cur.fetchall()
+            return rows[:limit], len(rows) > limit
 
-    async def get_subcategories(self, category_id: int, page: int = 0):
-        async with self._conn.cursor() as cur:
+    async def get_subcategories(self, category_id: int, limit: int, after: PageKey | None = None):
+        async with self._conn.cursor(row_factory=class_row(CatalogNode)) as cur:
             query = '''
-                SELECT id, name
+                SELECT id, name, product_count, min_price, max_price
                 FROM panel_subcategory
-                WHERE category_id = %s
-                ORDER BY name
+                WHERE category_id = %s AND product_count > 0
             '''
-            await cur.execute(query, (category_id,))
-            return await cur.fetchall()
+            query, params = seek(query, [category_id], limit, after)
+            await cur.execute(query, params)
+            rows = await cur.fetchall()
+            return rows[:limit], len(rows) > limit
 
-    async def get_products(self, subcategory_id: int, page: int = 0):
-        async with self._conn.cursor(row_factory=dict_row) as cur:
+    async def get_products(self, subcategory_id: int, limit: int, after: PageKey | None = None):
+        async with self._conn.cursor(row_factory=class_row(Product)) as cur:
             query = '''
-                SELECT id, name, description, price, image
+                SELECT id, name, description, price, image, version
                 FROM panel_product WHERE subcategory_id = %s
-                ORDER BY name
             '''
-            await cur.execute(query, (subcategory_id,))
+            query, params = seek(query, [subcategory_id], limit, after)
+            await cur.execute(query, params)
             rows = await cur.fetchall()
-            products = [Product.model_validate(row) for row in rows]
-            return products
+            return rows[:limit], len(rows) > limit
 
-    async def get_product_by_id(self, product_id: str) -> Product:
-        async with self._conn.cursor(row_factory=dict_row) as cur:
+    async def get_product_by_id(self, product_id: str) -> Product | None:
+        """Товар на витрине; удаленный или снятый с продажи (без подкатегории) - None."""
+        async with self._conn.cursor(row_factory=class_row(Product)) as cur:
             query = '''
-                SELECT id, name, description, price, image
-                FROM panel_product WHERE id = %s
+                SELECT id, name, description, price, image, version
+                FROM panel_product WHERE id = %s AND subcategory_id IS NOT NULL
             '''
             await cur.execute(query, (product_id,))
-            row = await cur.fetchone()
-            return Product.model_validate(row)
+            return await cur.fetchone()
+
+    async def get_products_by_ids(self, product_ids: typing.Iterable[str | UUID]) -> dict[str, Product]:
+        """Актуальные товары по списку id одним запросом.
+
+        Товары, удаленные или снятые с витрины (без подкатегории), в результат не попадают.
+        """
+        ids = [UUID(str(product_id)) for product_id in product_ids]
+        if not ids:
+            return {}
+        async with self._conn.cursor(row_factory=class_row(Product)) as cur:
+            query = '''
+                SELECT id, name, description, price, image, version
+                FROM panel_product
+                WHERE id = ANY(%s) AND subcategory_id IS NOT NULL
+            '''
+            # Текст запроса не зависит от числа id, поэтому его можно подготовить один раз на соединение
+            await cur.execute(query, (ids,), prepare=True)
+            return {str(product.id): product for product in await cur.fetchall()}
 
     async def add_user(self, user: User) -> bool:
+        return bool(await self.add_users([user]))
+
+    async def add_users(self, users: typing.Sequence[User]) -> list[int]:
+        """Регистрирует пользователей одним запросом, уже известные пропускаются.
+
+        Возвращает id пользователей, которых в базе еще не было.
+        """
+        if not users:
+            return []
         async with self._conn.cursor() as cur:
+            # unnest вместо VALUES: текст запроса не зависит от размера пачки и подготавливается один раз
             stmt = '''
                 INSERT INTO panel_userbot(id, first_name, username, is_admin, is_staff)
-                VALUES (%s, %s, %s, False, False)
+                SELECT id, first_name, coalesce(username, ''), False, False
+                FROM unnest(%s::bigint[], %s::text[], %s::text[]) AS u(id, first_name, username)
+                ON CONFLICT (id) DO NOTHING
+                RETURNING id
+            '''
+            params = (
+                [user.id for user in users],
+                [user.first_name for user in users],
+                [user.username for user in users],
+            )
+            await cur.execute(stmt, params, prepare=True)
+            return [user_id for (user_id,) in await cur.fetchall()]
+
+    async def search_products(self, words: typing.Sequence[str], limit: int, offset: int = 0):
+        """Поиск товаров по названию и описанию через GIN-индекс по search_vector."""
+        async with self._conn.cursor(row_factory=class_row(Product)) as cur:
+            query = '''
+                SELECT id, name, description, price, image, version
+                FROM panel_product, to_tsquery('russian', %s) AS q
+                WHERE subcategory_id IS NOT NULL AND (numnode(q) = 0 OR search_vector @@ q)
+                ORDER BY ts_rank(search_vector, q) DESC, name, id
+                LIMIT %s OFFSET %s
             '''
-            try:
-                await cur.execute(stmt, (user.id, user.first_name, user.username))
-            except psycopg.IntegrityError:
-                return False
-            return True
+            await cur.execute(query, (prefix_tsquery(words), limit + 1, offset), prepare=True)
+            rows = await cur.fetchall()
+            return rows[:limit], len(rows) > limit
+
+    async def search_faq(self, words: typing.Sequence[str], limit: int, offset: int = 0):
+        """Поиск по FAQ через GIN-индекс по search_vector, каждое слово ищется как префикс.
+
+        Если в запросе нет значимых слов (пустой или только стоп-слова), возвращаются все записи.
+        """
+        async with self._conn.cursor(row_factory=class_row(FAQ)) as cur:
+            query = '''
+                SELECT id, question, answer
+                FROM panel_faq, to_tsquery('russian', %s) AS q
+                WHERE numnode(q) = 0 OR search_vector @@ q
+                ORDER BY ts_rank(search_vector, q) DESC, position, id
+                LIMIT %s OFFSET %s
+            '''
+            await cur.execute(query, (prefix_tsquery(words), limit + 1, offset), prepare=True)
+            rows = await cur.fetchall()
+            return rows[:limit], len(rows) > limit
 
     async def get_active_promo(self, cur_time):
         promo_query = '''
-            SELECT id, text, cover, link, text_link
+            SELECT id, text, cover, link, text_link, cover_file_id
             FROM panel_promo
             WHERE start_time <= %s AND active = True
             ORDER BY start_time
         '''
-        async with self._conn.cursor(row_factory=dict_row) as cur:
+        async with self._conn.cursor(row_factory=class_row(Promo)) as cur:
             await cur.execute(promo_query, (cur_time,))
-            row = await cur.fetchone()
+            return await cur.fetchone()
+
+    async def get_next_promo_time(self) -> datetime | None:
+        """Время начала ближайшего активного промо (может быть в прошлом, если рассылка не завершена)."""
+        async with self._conn.cursor() as cur:
+            await cur.execute('SELECT min(start_time) FROM panel_promo WHERE active = True')
+            (start_time,) = await cur.fetchone()
+            return start_time
 
-            if not row:
-                return
-            return Promo.model_validate(row)
+    async def count_users(self, after_id: int = 0, until_id: int | None = None) -> int:
+        async with self._conn.cursor() as cur:
+            query, params = 'SELECT count(*) FROM panel_userbot WHERE id > %s', [after_id]
+            if until_id is not None:
+                query, params = query + ' AND id <= %s', [*params, until_id]
+            await cur.execute(query, params)
+            (count,) = await cur.fetchone()
+            return count
+
+    async def get_user_ids(self, after_id: int, limit: int, until_id: int | None = None) -> list[int]:
+        # Keyset по первичному ключу: каждый батч - короткий запрос без курсора и долгой транзакции
+        async with self._conn.cursor() as cur:
+            query, params = 'SELECT id FROM panel_userbot WHERE id > %s', [after_id]
+            if until_id is not None:
+                query, params = query + ' AND id <= %s', [*params, until_id]
+            await cur.execute(query + ' ORDER BY id LIMIT %s', [*params, limit])
+            return [user_id for (user_id,) in await cur.fetchall()]
 
-    async def get_users_by_batch(self):
-        async with self._conn.cursor(name="cursor1", row_factory=dict_row) as cur:
-            cur.itersize = 50
+    async def set_promo_cover_file_id(self, promo_id, file_id):
+        async with self._conn.cursor() as cur:
+            stmt = '''
+                UPDATE panel_promo
+                SET cover_file_id = %s
+                WHERE id = %s
+            '''
+            await cur.execute(stmt, (file_id, promo_id))
+
+    async def plan_promo_shards(self, promo_id: int, shard_size: int) -> int:
+        """Делит аудиторию промо на шарды примерно по shard_size пользователей, если этого еще не сделали.
+
+        Реплики стартуют одновременно, поэтому разбиение строится под advisory-локом промо:
+        остальные дождутся коммита и увидят готовые шарды. Возвращает число шардов.
+        """
+        async with self._conn.cursor() as cur:
+            await cur.execute('SELECT pg_advisory_xact_lock(%s, %s)', (PROMO_LOCK_SPACE, promo_id))
+            await cur.execute('SELECT count(*) FROM panel_promoshard WHERE promo_id = %s', (promo_id,))
+            (count,) = await cur.fetchone()
+            if count:
+                return count
+
+            # Каждый shard_size-й id - верхняя граница шарда. Последний шард открыт сверху
+            # и заодно захватывает пользователей, пришедших во время рассылки
             query = '''
-                SELECT *
-                FROM panel_userbot
+                SELECT id
+                FROM (SELECT id, row_number() OVER (ORDER BY id) AS n FROM panel_userbot) AS u
+                WHERE n %% %s = 0
+                ORDER BY id
             '''
-            await cur.execute(query)
+            await cur.execute(query, (shard_size,))
+            bounds = [user_id for (user_id,) in await cur.fetchall()]
+            stmt = '''
+                INSERT INTO panel_promoshard(promo_id, start_id, end_id, sent, failed)
+                SELECT %s, start_id, end_id, 0, 0
+                FROM unnest(%s::bigint[], %s::bigint[]) AS s(start_id, end_id)
+            '''
+            await cur.execute(stmt, (promo_id, [0, *bounds], [*bounds, None]))
+            return len(bounds) + 1
 
-            async for row in cur:
-                yield row
+    async def claim_promo_shard(self, promo_id: int, owner: str, lease: float) -> PromoShard | None:
+        """Берет в аренду на lease секунд незавершенный шард: свободный, с истекшей арендой
+        или свой (рассылка, прерванная ошибкой, продолжается сразу, не дожидаясь конца аренды).
+
+        SKIP LOCKED: реплики, забирающие шарды одновременно, не ждут друг друга и не получат один шард.
+        """
+        async with self._conn.cursor(row_factory=class_row(PromoShard)) as cur:
+            stmt = '''
+                UPDATE panel_promoshard
+                SET lease_owner = %s, lease_expires_at = now() + make_interval(secs => %s)
+                WHERE id = (
+                    SELECT id
+                    FROM panel_promoshard
+                    WHERE promo_id = %s AND done_at IS NULL
+                      AND (lease_expires_at IS NULL OR lease_expires_at < now() OR lease_owner = %s)
+                    ORDER BY start_id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, start_id, end_id, last_sent_user_id
+            '''
+            await cur.execute(stmt, (owner, lease, promo_id, owner))
+            return await cur.fetchone()
+
+    async def renew_promo_shard(
+        self, shard_id: int, owner: str, last_sent_user_id: int, sent: int, failed: int, lease: float,
+    ) -> bool:
+        """Сохраняет чекпоинт шарда и продлевает аренду. False - аренду уже забрала другая реплика."""
+        async with self._conn.cursor() as cur:
+            stmt = '''
+                UPDATE panel_promoshard
+                SET last_sent_user_id = %s, sent = sent + %s, failed = failed + %s,
+                    lease_expires_at = now() + make_interval(secs => %s)
+                WHERE id = %s AND lease_owner = %s
+            '''
+            await cur.execute(stmt, (last_sent_user_id, sent, failed, lease, shard_id, owner))
+            return cur.rowcount > 0
+
+    async def complete_promo_shard(self, shard_id: int, owner: str) -> bool:
+        async with self._conn.cursor() as cur:
+            stmt = '''
+                UPDATE panel_promoshard
+                SET done_at = now(), lease_owner = NULL, lease_expires_at = NULL
+                WHERE id = %s AND lease_owner = %s
+            '''
+            await cur.execute(stmt, (shard_id, owner))
+            return cur.rowcount > 0
 
-    async def update_promo(self, promo_id, cur_time):
+    async def get_promo_lease_expiry(self, promo_id: int) -> datetime | None:
+        """Когда освободится ближайший незавершенный шард (None - незавершенных нет)."""
         async with self._conn.cursor() as cur:
-            stmt_promo = '''
+            query = '''
+                SELECT min(coalesce(lease_expires_at, now()))
+                FROM panel_promoshard
+                WHERE promo_id = %s AND done_at IS NULL
+            '''
+            await cur.execute(query, (promo_id,))
+            (expires_at,) = await cur.fetchone()
+            return expires_at
+
+    async def count_promo_replicas(self, promo_id: int) -> int:
+        """Сколько реплик сейчас держат аренду шардов промо."""
+        async with self._conn.cursor() as cur:
+            query = '''
+                SELECT count(DISTINCT lease_owner)
+                FROM panel_promoshard
+                WHERE promo_id = %s AND done_at IS NULL AND lease_expires_at > now()
+            '''
+            await cur.execute(query, (promo_id,))
+            (count,) = await cur.fetchone()
+            return count
+
+    async def finish_promo(self, promo_id: int, cur_time: datetime) -> bool:
+        """Отключает промо, если все шарды завершены. True получит только одна из реплик."""
+        async with self._conn.cursor() as cur:
+            stmt = '''
                 UPDATE panel_promo
                 SET active = False, last_succeeded_at = %s
-                WHERE id = %s
+                WHERE id = %s AND active = True
+                  AND NOT EXISTS (SELECT 1 FROM panel_promoshard WHERE promo_id = %s AND done_at IS NULL)
             '''
-            await cur.execute(stmt_promo, (cur_time, promo_id))
+            await cur.execute(stmt, (cur_time, promo_id, promo_id))
+            return cur.rowcount > 0
+
+    async def add_order(self, order: Order) -> int | None:
+        """Сохраняет заказ, возвращает его id или None, если платеж уже был записан."""
+        async with self._conn.cursor() as cur:
+            # Заказ и первая запись истории статусов - одним запросом
+            stmt = '''
+                WITH new_order AS (
+                    INSERT INTO panel_order(
+                        provider_payment_charge_id, telegram_payment_charge_id, user_id, client_username,
+                        paid_amount, currency, fio, phone, address, status, created_at
+                    )
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'paid', now())
+                    ON CONFLICT (provider_payment_charge_id) DO NOTHING
+                    RETURNING id
+                ), history AS (
+                    INSERT INTO panel_orderstatuschange(order_id, old_status, new_status, changed_at)
+                    SELECT id, NULL, 'paid', now() FROM new_order
+                )
+                SELECT id FROM new_order
+            '''
+            await cur.execute(stmt, (
+                order.provider_payment_charge_id, order.telegram_payment_charge_id, order.user_id,
+                order.client_username, order.paid_amount, order.currency, order.fio, order.phone, order.address,
+            ))
+            row = await cur.fetchone()
+            if row is None:
+                return None
+
+            (order_id,) = row
+            stmt_items = '''
+                INSERT INTO panel_orderitem(order_id, product_id, name, price, quantity)
+                VALUES (%s, %s, %s, %s, %s)
+            '''
+            await cur.executemany(
+                stmt_items,
+                [(order_id, item.product_id, item.name, item.price, item.quantity) for item in order.items],
+            )
+            return order_id
+
+    async def refund_order(self, provider_payment_charge_id: str) -> int | None:
+        """Помечает заказ возвращенным и пишет переход в историю статусов.
+
+        Поиск по уникальному индексу provider_payment_charge_id. Возвращает id заказа
+        или None, если заказ не найден или возврат уже был учтен.
+        """
+        async with self._conn.cursor() as cur:
+            stmt = '''
+                WITH prev AS (
+                    SELECT id, status
+                    FROM panel_order
+                    WHERE provider_payment_charge_id = %s
+                    FOR UPDATE
+                ), updated AS (
+                    UPDATE panel_order o
+                    SET status = 'refunded'
+                    FROM prev
+                    WHERE o.id = prev.id AND prev.status <> 'refunded'
+                    RETURNING o.id, prev.status AS old_status
+                )
+                INSERT INTO panel_orderstatuschange(order_id, old_status, new_status, changed_at)
+                SELECT id, old_status, 'refunded', now() FROM updated
+                RETURNING order_id
+            '''
+            await cur.execute(stmt, (provider_payment_charge_id,))
+            row = await cur.fetchone()
+            return row[0] if row else None
+
+    async def iter_orders(self):
+        query = '''
+            SELECT o.id, o.provider_payment_charge_id, o.paid_amount, o.fio, o.phone, o.address,
+                   o.status, o.client_username,
+                   json_agg(
+                       json_build_object('id', i.product_id, 'name', i.name, 'price', i.price, 'quantity', i.quantity)
+                       ORDER BY i.id
+                   ) FILTER (WHERE i.id IS NOT NULL) AS items
+            FROM panel_order o
+            LEFT JOIN panel_orderitem i ON i.order_id = o.id
+            GROUP BY o.id
+            ORDER BY o.id
+        '''
+        async with self._conn.cursor(name='orders_export', row_factory=dict_row) as cur:
+            cur.itersize = 500
+            await cur.execute(query)
+            async for row in cur:
+                yield row
+
+    async def notify(self, channel: str, payload: dict):
+        # NOTIFY транзакционный: слушатели получат уведомление после коммита
+        async with self._conn.cursor() as cur:
+            await cur.execute('SELECT pg_notify(%s, %s)', (channel, json.dumps(payload)))
+
+    async def mark_update_processed(self, update_id: int) -> bool:
+        """Возвращает False, если апдейт уже обрабатывался."""
+        async with self._conn.cursor() as cur:
+            stmt = '''
+                INSERT INTO panel_processedupdate(update_id, created_at)
+                VALUES (%s, now())
+                ON CONFLICT (update_id) DO NOTHING
+                RETURNING update_id
+            '''
+            await cur.execute(stmt, (update_id,))
+            return await cur.fetchone() is not None
+
+    async def delete_processed_updates(self, before: datetime):
+        async with self._conn.cursor() as cur:
+            await cur.execute('DELETE FROM panel_processedupdate WHERE created_at < %s', (before,))
 
 
 class SQLAlchemyRepository:
@@ -1,18 +1,33 @@
+import html
+from typing import AsyncContextManager
+
 from aiogram import F, Router, types
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
+from dependency_injector.wiring import Provide, inject
 
-from config import bot
+from config import FAQ_INLINE_CACHE_TIME, FAQ_PAGE_SIZE, Container, bot
+from db.cache import TTLCache
+from db.models import FAQ
+from db.repository import Repository
+from utils import normalize_query
 
 router = Router()
 
 
-FAQ = [
-    {"question": "Как зарегистрироваться?", "answer": "Нажмите /start и следуйте инструкциям."},
-    {"question": "Как изменить пароль?", "answer": "Перейдите в настройки и выберите 'Сменить пароль'."},
-    {"question": "Что делать, если забыл пароль?", "answer": "Используйте функцию 'Восстановить пароль' на сайте."},
-    {"question": "Как связаться с поддержкой?", "answer": "Напишите на support@example.com."},
-]
+SUPPORT_BUTTON = types.InlineQueryResultsButton(text="Связаться с поддержкой", start_parameter="support")
+
+
+def build_article(faq: FAQ) -> types.InlineQueryResultArticle:
+    return types.InlineQueryResultArticle(
+        id=str(faq.id),
+        title=faq.question,
+        description=faq.answer[:50] + "...",
+        input_message_content=types.InputTextMessageContent(
+            message_text=f"<b>{html.escape(faq.question)}</b>\n{html.escape(faq.answer)}",
+            parse_mode="HTML"
+        )
+    )
 
 
 @router.message(F.text.lower() == 'faq')
@@ -26,22 +41,27 @@ async def cart_handler(message: Message, state: FSMContext) -> None:
 
 
 @router.inline_query()
-async def inline_faq(inline_query: types.InlineQuery):
-    query_text = inline_query.query.lower()
-    results = []
-
-    for idx, faq in enumerate(FAQ):
-        if not query_text or query_text in faq["question"].lower():
-            result = types.InlineQueryResultArticle(
-                id=str(idx),
-                title=faq["question"],
-                description=faq["answer"][:50] + "...",
-                input_message_content=types.InputTextMessageContent(
-                    message_text=f"<b>{faq['question']}</b>\n{faq['answer']}",
-                    parse_mode="HTML"
-                )
-            )
-            results.append(result)
-
-    button = types.InlineQueryResultsButton(text="Связаться с поддержкой", start_parameter="support")
-    await inline_query.answer(results, is_personal=True, button=button)
+@inject
+async def inline_faq(
+    inline_query: types.InlineQuery,
+    repository: AsyncContextManager[Repository] = Provide[Container.repository],
+    cache: TTLCache = Provide[Container.faq_cache],
+):
+    words = normalize_query(inline_query.query)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+
+    async def load():
+        async with repository as repo:
+            items, has_next = await repo.search_faq(words, FAQ_PAGE_SIZE, offset)
+        next_offset = str(offset + FAQ_PAGE_SIZE) if has_next else ''
+        return [build_article(faq) for faq in items], next_offset
+
+    # Результаты одинаковы для всех пользователей, поэтому их можно кэшировать и у нас, и в Telegram
+    results, next_offset = await cache.get_or_load(('faq', words, offset), load)
+    await inline_query.answer(
+        results,
+        cache_time=FAQ_INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=next_offset,
+        button=SUPPORT_BUTTON,
+    )
@@ -1,5 +1,22 @@
+import atexit
+import copy
+import json
 import logging
 import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from os import getenv
+from pathlib import Path
+from queue import SimpleQueue
+
+LOG_DIR = Path(__file__).resolve().parent
+LOG_FILE_MAX_BYTES = int(getenv('LOG_FILE_MAX_BYTES', 10 * 1024 * 1024))
+LOG_FILE_ROTATE_INTERVAL = int(getenv('LOG_FILE_ROTATE_INTERVAL', 24 * 60 * 60))
+LOG_FILE_BACKUP_COUNT = int(getenv('LOG_FILE_BACKUP_COUNT', 7))
+# Сколько записей с одним шаблоном сообщения пропускать за окно, остальные только подсчитываются
+LOG_SAMPLE_BURST = int(getenv('LOG_SAMPLE_BURST', 20))
+LOG_SAMPLE_INTERVAL = float(getenv('LOG_SAMPLE_INTERVAL', 60))
 
 
 class LogFormatter(logging.Formatter):
@@ -11,24 +28,129 @@ class LogFormatter(logging.Formatter):
     green = "\x1b[32;21m"
     bold_red = "\x1b[31;1m"
     reset = "\x1b[0m"
-    format = "[%(levelname)s] %(asctime)s | %(name)s | %(message)s (%(filename)s:%(lineno)d)"
-    datefmt = '%Y-%m-%d %H:%M'
-
-    FORMATS = {
-        logging.DEBUG: grey + format + reset,
-        logging.INFO: green + format + reset,
-        logging.WARNING: yellow + format + reset,
-        logging.ERROR: red + format + reset,
-        logging.CRITICAL: bold_red + format + reset
+    log_format = "[%(levelname)s] %(asctime)s | %(name)s | %(message)s (%(filename)s:%(lineno)d)"
+    date_format = '%Y-%m-%d %H:%M:%S'
+
+    COLORS = {
+        logging.DEBUG: grey,
+        logging.INFO: green,
+        logging.WARNING: yellow,
+        logging.ERROR: red,
+        logging.CRITICAL: bold_red,
     }
 
+    def __init__(self):
+        super().__init__()
+        # Форматтеры собираются один раз, а не на каждую запись
+        self._formatters = {
+            level: logging.Formatter(color + self.log_format + self.reset, datefmt=self.date_format)
+            for level, color in self.COLORS.items()
+        }
+        self._default = logging.Formatter(self.log_format, datefmt=self.date_format)
+
+    def format(self, record):
+        return self._formatters.get(record.levelno, self._default).format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON, для файла и сборщиков логов."""
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt, datefmt='%Y-%m-%d %H:%M:%S')
-        return formatter.format(record)
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'process': record.process,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SizedTimedRotatingFileHandler(RotatingFileHandler):
+    """Ротация файла по размеру или по прошествии interval секунд, что наступит раньше."""
+
+    def __init__(self, filename: str | Path, max_bytes: int, interval: int, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
 
+class SamplingFilter(logging.Filter):
+    """Ограничивает повторяющиеся записи: не больше burst записей с одним шаблоном за interval секунд.
 
-def setup_logger(file_logger: bool = True):
+    Первая запись следующего окна сообщает, сколько похожих записей было пропущено.
+    """
+
+    def __init__(self, burst: int = 20, interval: float = 60.0, level: int = logging.INFO):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.level = level
+        # (logger, уровень, шаблон) -> [начало окна, пропущено записей, отброшено записей]
+        self._windows: dict[tuple, list] = {}
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            dropped = window[2] if window else 0
+            self._windows[key] = [now, 1, 0]
+            if len(self._windows) > 10_000:
+                self._windows = {k: v for k, v in self._windows.items() if now - v[0] < self.interval}
+            if dropped:
+                record = copy.copy(record)
+                record.msg = f'{record.msg} (пропущено похожих записей: {dropped})'
+                return record
+            return True
+
+        window[1] += 1
+        if window[1] <= self.burst:
+            return True
+        window[2] += 1
+        return False
+
+
+class LogQueueHandler(QueueHandler):
+    """Кладет запись в очередь, форматирование и запись на диск идут в потоке QueueListener.
+
+    В отличие от стандартного prepare, traceback хранится отдельно от текста сообщения,
+    чтобы JSON-форматтер мог вынести его в свое поле.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def setup_logger(file_logger: bool = True, log_file: str = 'logs.log') -> QueueListener:
+    """Логи пишутся в очередь, консоль и файл обслуживает отдельный поток."""
     logging.getLogger('apscheduler').setLevel(logging.WARNING)
 
     logger = logging.getLogger()
@@ -37,10 +159,25 @@ def setup_logger(file_logger: bool = True):
     ch = logging.StreamHandler(stream=sys.stdout)
     ch.setLevel(logging.INFO)
     ch.setFormatter(LogFormatter())
-    logger.addHandler(ch)
+    handlers = [ch]
 
     if file_logger:
-        fh = logging.FileHandler('src/logs/logs.log')
+        fh = SizedTimedRotatingFileHandler(
+            LOG_DIR / log_file,
+            max_bytes=LOG_FILE_MAX_BYTES,
+            interval=LOG_FILE_ROTATE_INTERVAL,
+            backup_count=LOG_FILE_BACKUP_COUNT,
+        )
         fh.setLevel(logging.INFO)
-        fh.setFormatter(LogFormatter())
-        logger.addHandler(fh)
+        fh.setFormatter(JsonFormatter())
+        handlers.append(fh)
+
+    queue_handler = LogQueueHandler(SimpleQueue())
+    queue_handler.addFilter(SamplingFilter(burst=LOG_SAMPLE_BURST, interval=LOG_SAMPLE_INTERVAL))
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Дописывает очередь при выходе из процесса
+    atexit.register(listener.stop)
+    return listener
@@ -1,46 +1,66 @@
 import asyncio
-import logging
+import multiprocessing
+import signal
 import sys
+from functools import partial
 from typing import AsyncContextManager
 
+from aiogram import Dispatcher
 from aiogram.filters import CommandStart
-from aiogram.types import Message
+from aiogram.types import ChatMemberUpdated, Message
 from aiogram.utils.keyboard import KeyboardButton, ReplyKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from dependency_injector.wiring import Provide, inject
 
 from cart.router import router as cart_router
-from config import bot, dp, Container
+from config import (
+    BOT_MODE,
+    METRICS_PORT,
+    WEBHOOK_HOST,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WEBHOOK_WORKERS,
+    bot,
+    dp,
+    Container,
+)
+from db.cache import CATALOG_CHANNEL, FAQ_CHANNEL, invalidate_catalog
+from db.config import POOL_STATS_INTERVAL, POSTGRES_CONNINFO, report_pool_stats
+from db.fsm import FSMFlushMiddleware, PostgresEventIsolation
 from db.repository import Repository
 from faq.router import router as faq_router
 from logs.config import setup_logger
+from metrics import (
+    HandlerNameMiddleware,
+    TelegramMetricsMiddleware,
+    UpdateMetricsMiddleware,
+    start_metrics_server,
+)
 from products.router import router as product_router
-from tasks.promo import promote
-
-SUBSCRIBE_TO = []
-
-
-async def check_subscription(channel_id: int, user_id: int) -> bool:
-    try:
-        member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-        return member.status in ['member', 'administrator', 'creator']
-    except Exception:
-        return False
+from subscriptions import SUBSCRIPTION_CHANNEL, SubscriptionChecker
+from tasks.promo import PROMO_CHANNEL, PromoScheduler
+from tasks.users import UserRegistrar
+from utils import export_orders
+from webhook import UpdateDedupMiddleware, cleanup_processed_updates
 
 
 @dp.message(CommandStart())
 @inject
 async def command_start_handler(
     message: Message,
-    repository: AsyncContextManager[Repository] = Provide[Container.repository],
+    subscription_checker: SubscriptionChecker = Provide[Container.subscription_checker],
+    user_registrar: UserRegistrar = Provide[Container.user_registrar],
 ) -> None:
-    if not all([check_subscription(ch, message.from_user.id) for ch in SUBSCRIBE_TO]):
-        message.answer('Отсутствуют подписки на необходимые каналы')
+    if not await subscription_checker.is_subscribed(message.from_user.id):
+        await message.answer('Отсутствуют подписки на необходимые каналы')
         return
 
-    async with repository as repo:
-        if await repo.add_user(message.from_user):
-            logging.info('Новый пользователь @%s(%s)', message.from_user.username, message.from_user.id)
+    # Повторный /start не обращается к базе, новые пользователи записываются пачками в фоне
+    user_registrar.register(message.from_user)
 
     kb = [
         [KeyboardButton(text="Каталог")],
@@ -56,24 +76,198 @@ async def command_start_handler(
     )
 
 
-async def main() -> None:
-    setup_logger()
+@dp.chat_member()
+@inject
+async def chat_member_handler(
+    event: ChatMemberUpdated,
+    subscription_checker: SubscriptionChecker = Provide[Container.subscription_checker],
+    repository: AsyncContextManager[Repository] = Provide[Container.repository],
+) -> None:
+    # Приходит из каналов, где бот администратор: подписка пользователя изменилась
+    user_id = event.new_chat_member.user.id
+    subscription_checker.invalidate(user_id)
+    async with repository as repo:
+        await repo.notify(SUBSCRIPTION_CHANNEL, {'user_id': user_id})
 
+
+async def export_orders_to_file() -> None:
     container = Container()
+    await container.init_resources()
+
+    async with await container.repository.async_() as repo:
+        await export_orders(repo.iter_orders())
+
+    await container.shutdown_resources()
+
+
+async def start_handler_services(dispatcher: Dispatcher, container: Container) -> None:
+    """Только то, без чего не работают хэндлеры: пул, FSM в Postgres и фоновая запись заказов и пользователей.
+
+    Метрики, слушатель уведомлений и планировщик запускает on_startup (нагрузочному тесту они не нужны).
+    """
+    # Пул открывается здесь один раз, а не в каждом хэндлере
+    await container.init_resources()
+
+    # Корзины и состояния навигации хранятся в Postgres и переживают перезапуск
+    fsm_storage = await container.fsm_storage()
+    dispatcher.fsm.storage = fsm_storage
+    # Запись FSM выполняется внутри лока events_isolation (FSMContextMiddleware снаружи этого middleware)
+    dispatcher.update.outer_middleware(FSMFlushMiddleware(fsm_storage))
+
+    order_writer = container.order_writer()
+    order_writer.start()
+    user_registrar = container.user_registrar()
+    user_registrar.start()
+
+    dispatcher['container'] = container
+    dispatcher['order_writer'] = order_writer
+    dispatcher['user_registrar'] = user_registrar
+
+
+async def stop_handler_services(dispatcher: Dispatcher) -> None:
+    # Дописываем заказы, принятые до остановки
+    await dispatcher['order_writer'].stop()
+    await dispatcher['user_registrar'].stop()
+    await dispatcher['container'].shutdown_resources()
+
+
+async def on_startup(dispatcher: Dispatcher, worker_id: int = 0) -> None:
+    container = Container()
+
+    if BOT_MODE == 'webhook':
+        # Апдейты одного пользователя попадают в разные процессы и реплики, локальный кэш FSM был бы несогласованным
+        container.fsm_storage.add_kwargs(cache_ttl=0)
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + worker_id)
+
+    await start_handler_services(dispatcher, container)
+    # Апдейты начнут поступать только после startup, поэтому id успевают загрузиться до первого /start
+    await dispatcher['user_registrar'].load()
+
+    if BOT_MODE == 'webhook':
+        # Апдейты одного пользователя могут прийти в разные процессы и реплики
+        dispatcher.fsm.events_isolation = PostgresEventIsolation(POSTGRES_CONNINFO)
+
+    if BOT_MODE == 'webhook':
+        dispatcher.update.outer_middleware(UpdateDedupMiddleware(container.repository.provider))
+
+    catalog_cache = container.catalog_cache()
+    product_cache = container.product_cache()
+    listener = container.listener()
+    listener.subscribe(CATALOG_CHANNEL, partial(invalidate_catalog, catalog_cache, product_cache))
+    listener.on_connect(catalog_cache.clear)
+    listener.on_connect(product_cache.clear)
+
+    faq_cache = container.faq_cache()
+    listener.subscribe(FAQ_CHANNEL, lambda event: faq_cache.clear())
+    listener.on_connect(faq_cache.clear)
+
+    subscription_checker = container.subscription_checker()
+    listener.subscribe(SUBSCRIPTION_CHANNEL, lambda event: subscription_checker.invalidate(event['user_id']))
+    listener.on_connect(subscription_checker.clear)
 
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(promote, 'interval', minutes=1,)
+    # Пул у каждого процесса свой, статистику отдают все
+    scheduler.add_job(report_pool_stats, 'interval', seconds=POOL_STATS_INTERVAL, args=[await container.pool.async_()])
+    # Фоновые задачи выполняет один процесс реплики, рассылку промо реплики делят между собой по шардам
+    if worker_id == 0:
+        # Рассылка стартует точно в start_time, а не на ближайшей минутной проверке
+        promo_scheduler = PromoScheduler(scheduler, container.repository.provider)
+        listener.subscribe(PROMO_CHANNEL, promo_scheduler.arm)
+        # Заодно это первичное планирование при старте
+        listener.on_connect(promo_scheduler.arm)
+        if BOT_MODE == 'webhook':
+            scheduler.add_job(cleanup_processed_updates, 'interval', hours=1, args=[container.repository.provider])
     scheduler.start()
 
+    dispatcher['listener_task'] = asyncio.create_task(listener.run())
+    dispatcher['scheduler'] = scheduler
+
+
+async def on_shutdown(dispatcher: Dispatcher) -> None:
+    dispatcher['scheduler'].shutdown(wait=False)
+    dispatcher['listener_task'].cancel()
+    await stop_handler_services(dispatcher)
+
+
+def setup_dispatcher(startup=on_startup, shutdown=on_shutdown) -> None:
     dp.include_router(product_router)
     dp.include_router(cart_router)
     dp.include_router(faq_router)
 
-    await dp.start_polling(bot)
-    await container.shutdown_resources()
+    # Метрики снаружи остальных middleware, чтобы учитывать и запись FSM в конце апдейта
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    for update_type in dp.resolve_used_update_types():
+        dp.observers[update_type].middleware(HandlerNameMiddleware())
+    bot.session.middleware(TelegramMetricsMiddleware())
+
+    dp.startup.register(startup)
+    dp.shutdown.register(shutdown)
+
+
+async def run_polling() -> None:
+    setup_logger()
+    setup_dispatcher()
+
+    # Пока установлен вебхук, getUpdates не работает
+    await bot.delete_webhook()
+    # chat_member не приходит, пока не указан в allowed_updates явно
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+
+
+def run_webhook_worker(worker_id: int) -> None:
+    # Ротацию одного файла из нескольких процессов не сделать без гонок, поэтому у воркера свой файл
+    setup_logger(log_file=f'logs-{worker_id}.log')
+    setup_dispatcher()
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot, worker_id=worker_id)
+
+    # reuse_port: все воркеры слушают один порт, входящие соединения распределяет ядро
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=True, print=None)
+
+
+async def set_webhook() -> None:
+    await bot.set_webhook(
+        url=f'{WEBHOOK_URL}{WEBHOOK_PATH}',
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        # Telegram принимает не больше 100 одновременных соединений
+        max_connections=min(100, max(40, WEBHOOK_WORKERS * 10)),
+    )
+    await bot.session.close()
+
+
+def run_webhook() -> None:
+    # Без секрета SimpleRequestHandler не проверяет заголовок, и апдейты может прислать кто угодно
+    if not WEBHOOK_SECRET:
+        sys.exit('В режиме вебхука обязателен WEBHOOK_SECRET')
+
+    setup_logger()
+    setup_dispatcher()
+    asyncio.run(set_webhook())
+
+    # spawn: воркеры импортируют модули заново и не наследуют сессию бота и пул соединений
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=run_webhook_worker, args=(i,)) for i in range(WEBHOOK_WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    # docker stop посылает SIGTERM только главному процессу, передаем его воркерам для штатной остановки
+    signal.signal(signal.SIGTERM, lambda *_: [worker.terminate() for worker in workers])
+    for worker in workers:
+        worker.join()
 
 
 if __name__ == "__main__":
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    asyncio.run(main())
+
+    if sys.argv[1:] == ['export-orders']:
+        asyncio.run(export_orders_to_file())
+    elif BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        asyncio.run(run_polling())
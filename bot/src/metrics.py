@@ -0,0 +1,167 @@
+import inspect
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject, Update
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+HANDLER_DURATION = Histogram(
+    'bot_handler_duration_seconds',
+    'Время обработки апдейта',
+    ['handler', 'update_type', 'outcome'],
+)
+HANDLER_REPOSITORY_TIME = Histogram(
+    'bot_handler_repository_seconds',
+    'Время в запросах к базе за один апдейт',
+    ['handler'],
+)
+HANDLER_TELEGRAM_TIME = Histogram(
+    'bot_handler_telegram_seconds',
+    'Время в запросах к Bot API за один апдейт',
+    ['handler'],
+)
+REPOSITORY_DURATION = Histogram(
+    'bot_repository_duration_seconds',
+    'Время вызова метода репозитория (connection - ожидание соединения из пула)',
+    ['method'],
+)
+TELEGRAM_DURATION = Histogram(
+    'bot_telegram_request_duration_seconds',
+    'Время запроса к Bot API',
+    ['method', 'outcome'],
+)
+BROADCAST_MESSAGES = Counter(
+    'bot_broadcast_messages_total',
+    'Сообщения рассылки по результату',
+    ['outcome'],
+)
+BROADCAST_RETRIES = Counter(
+    'bot_broadcast_retries_total',
+    'Повторы отправки в рассылке по причине',
+    ['reason'],
+)
+PROMOTE_DURATION = Histogram(
+    'bot_promote_duration_seconds',
+    'Длительность рассылки промо',
+    buckets=(1, 10, 60, 300, 900, 1800, 3600, 7200, 14400, float('inf')),
+)
+ORDER_QUEUE_DEPTH = Gauge(
+    'bot_order_queue_depth',
+    'События заказов, ожидающие записи в базу',
+)
+
+
+@dataclass(slots=True)
+class UpdateTimings:
+    handler: str = 'unhandled'
+    repository: float = 0.0
+    telegram: float = 0.0
+
+
+# Время, набранное за обработку текущего апдейта (у каждого апдейта своя задача и контекст)
+_timings: ContextVar[UpdateTimings | None] = ContextVar('update_timings', default=None)
+
+
+def start_metrics_server(port: int, addr: str = '0.0.0.0') -> None:
+    """HTTP-эндпоинт /metrics для Prometheus в отдельном потоке процесса."""
+    start_http_server(port, addr)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware апдейтов: длительность, исход и тип апдейта в разрезе хэндлеров.
+
+    Имя хэндлера становится известно только после фильтров, его проставляет HandlerNameMiddleware.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        timings = UpdateTimings()
+        token = _timings.set(timings)
+        outcome = 'error'
+        started = time.perf_counter()
+        try:
+            result = await handler(event, data)
+            outcome = 'unhandled' if result is UNHANDLED else 'ok'
+            return result
+        finally:
+            _timings.reset(token)
+            HANDLER_DURATION.labels(timings.handler, event.event_type, outcome).observe(time.perf_counter() - started)
+            HANDLER_REPOSITORY_TIME.labels(timings.handler).observe(timings.repository)
+            HANDLER_TELEGRAM_TIME.labels(timings.handler).observe(timings.telegram)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутренний middleware: запоминает, какой хэндлер обрабатывает апдейт."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object: HandlerObject | None = data.get('handler')
+        if handler_object is not None and (timings := _timings.get()) is not None:
+            callback = handler_object.callback
+            timings.handler = f'{callback.__module__}.{callback.__name__}'
+        return await handler(event, data)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого запроса к Bot API."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Any:
+        outcome = 'error'
+        started = time.perf_counter()
+        try:
+            result = await make_request(bot, method)
+            outcome = 'ok'
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            TELEGRAM_DURATION.labels(type(method).__name__, outcome).observe(elapsed)
+            if (timings := _timings.get()) is not None:
+                timings.telegram += elapsed
+
+
+def observe_repository(method: str, elapsed: float) -> None:
+    REPOSITORY_DURATION.labels(method).observe(elapsed)
+    if (timings := _timings.get()) is not None:
+        timings.repository += elapsed
+
+
+class TimedRepository:
+    """Обертка над репозиторием, которая замеряет время каждого вызова."""
+
+    def __init__(self, repository: Any):
+        self._repository = repository
+
+    def __getattr__(self, name: str):
+        method = getattr(self._repository, name)
+        # Генераторы (выгрузка заказов) отдают строки частями, замер всего вызова там не имеет смысла
+        if not inspect.iscoroutinefunction(method):
+            return method
+
+        async def call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                observe_repository(name, time.perf_counter() - started)
+        return call
@@ -1,7 +1,9 @@
+import re
 from typing import AsyncContextManager
 
-from aiogram import F, Router
+from aiogram import F, Router, types
 from aiogram.enums.parse_mode import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import CallbackQuery, Message
@@ -9,9 +11,11 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardButton
 from dependency_injector.wiring import Provide, inject
 
 from cart.cart import Cart
-from config import Container
-from db.repository import Repository
-from utils import are_keyboards_equal, escape_markdown_v2
+from config import PRODUCT_INLINE_CACHE_TIME, PRODUCT_SEARCH_PAGE_SIZE, Container
+from db.cache import TTLCache, freeze
+from db.models import CatalogNode, Product
+from db.repository import PageKey, Repository
+from utils import are_keyboards_equal, escape_markdown_v2, normalize_query
 
 
 router = Router()
@@ -29,86 +33,177 @@ class PaginationState(StatesGroup):
 async def get_items_by_state(
     data: dict,
     cur_state: State,
+    limit: int,
+    after: PageKey | None = None,
     repository: AsyncContextManager[Repository] = Provide[Container.repository],
 ):
-    items = []
     async with repository as repo:
         match cur_state:
             case PaginationState.category:
-                items = await repo.get_categories()
+                return await repo.get_categories(limit, after)
             case PaginationState.subcategory:
-                items = await repo.get_subcategories(data['category'])
+                return await repo.get_subcategories(data['category'], limit, after)
             case PaginationState.product:
-                items = await repo.get_products(data['subcategory'])
+                return await repo.get_products(data['subcategory'], limit, after)
             case _:
                 raise ValueError('Bad current state: ', cur_state)
-    return items
 
 
-async def get_paginated_builder(state: FSMContext, page: int, items_per_page: int = 6):
+def get_page_key(item: CatalogNode | Product) -> list:
+    """Ключ keyset-пагинации для последнего показанного элемента."""
+    if isinstance(item, Product):
+        return [item.name, str(item.id)]
+    return [item.name, item.id]
+
+
+def get_button_text(item: CatalogNode, data_type: str) -> str:
+    """Название ветки со сводкой из каталога: число товаров, для подкатегории еще и минимальная цена."""
+    if data_type == 'subcategory' and item.min_price is not None:
+        return f'{item.name} ({item.product_count}, от {item.min_price} руб.)'
+    return f'{item.name} ({item.product_count})'
+
+
+def get_keyboard_key(data: dict, data_type: str) -> tuple:
+    """Префикс ключа клавиатуры, совпадающий с ключами данных в кэше каталога.
+
+    Благодаря этому invalidate_catalog сбрасывает клавиатуры вместе со списками, из которых они собраны.
+    """
+    match data_type:
+        case 'category':
+            return ('keyboard', 'categories')
+        case 'subcategory':
+            return ('keyboard', 'subcategories', int(data['category']))
+        case _:
+            # Кнопка "Вернуться" ведет в категорию, поэтому она тоже входит в ключ
+            return ('keyboard', 'products', int(data['subcategory']), int(data['category']))
+
+
+@inject
+async def get_paginated_markup(
+    state: FSMContext,
+    cursors: list,
+    items_per_page: int = 6,
+    cache: TTLCache = Provide[Container.catalog_cache],
+):
+    """Клавиатура для страницы, начинающейся после ключа cursors[-1].
+
+    В cursors хранятся ключи начала всех просмотренных страниц (cursors[0] = None),
+    поэтому переход назад не требует повторного прохода по предыдущим страницам.
+    Страницы одинаковы для всех пользователей, поэтому готовая разметка кэшируется.
+    Возвращает (markup, ключ следующей страницы или None).
+    """
     data = await state.get_data()
     cur_state = await state.get_state()
     data_type = cur_state.split(':')[1]
 
-    items = await get_items_by_state(data, cur_state)
+    async def render():
+        show_items, has_next = await get_items_by_state(data, cur_state, items_per_page, cursors[-1])
 
-    if not items:
-        return
+        if not show_items:
+            return None, None
 
-    start = page * items_per_page
-    end = start + items_per_page
-    show_items = items[start:end]
+        builder = InlineKeyboardBuilder()
 
-    builder = InlineKeyboardBuilder()
+        for item in show_items:
+            if data_type == 'product':
+                builder.button(text=item.name, callback_data=f'{data_type}_{str(item.id)}')
+            else:
+                builder.button(text=get_button_text(item, data_type), callback_data=f'{data_type}_{item.id}')
 
-    for item in show_items:
-        if data_type == 'product':
-            builder.button(text=item.name, callback_data=f'{data_type}_{str(item.id)}')
-        else:
-            builder.button(text=item[1], callback_data=f'{data_type}_{item[0]}')
+        if cur_state == PaginationState.category:
+            builder.button(text='🔍 Поиск товаров', switch_inline_query_current_chat=PRODUCT_SEARCH_PREFIX)
+        elif cur_state == PaginationState.subcategory:
+            builder.button(text='↩️ Вернуться', callback_data='catalog')
+        elif cur_state == PaginationState.product:
+            category = data['category']
+            builder.button(text='↩️ Вернуться', callback_data=f'category_{category}')
 
-    if cur_state == PaginationState.subcategory:
-        builder.button(text='↩️ Вернуться', callback_data='catalog')
-    elif cur_state == PaginationState.product:
-        category = data['category']
-        builder.button(text='↩️ Вернуться', callback_data=f'category_{category}')
+        if len(cursors) > 1:
+            builder.button(text="⬅️ Назад", callback_data="prev_page")
+        if has_next:
+            builder.button(text="Вперед ➡️", callback_data="next_page")
 
-    if page > 0:
-        builder.button(text="⬅️ Назад", callback_data="prev_page")
-    if end < len(items):
-        builder.button(text="Вперед ➡️", callback_data="next_page")
+        adjust_items = [2] * int(len(show_items) / 2)  # [n] columns * number of rows
+        builder.adjust(*adjust_items, 1, 2)
 
-    adjust_items = [2] * int(len(items) / 2)  # [n] columns * number of rows
-    builder.adjust(*adjust_items, 1, 2)
+        next_cursor = get_page_key(show_items[-1]) if has_next else None
+        return builder.as_markup(), next_cursor
 
-    return builder
+    key = (*get_keyboard_key(data, data_type), items_per_page, freeze(cursors[-1]), len(cursors) > 1)
+    return await cache.get_or_load(key, render)
 
 
 @router.callback_query(F.data.in_(['prev_page', 'next_page']))
 async def switch_page(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
+    cursors = data['cursors']
     if callback.data == 'prev_page':
-        page = data['page'] - 1
+        cursors = cursors[:-1] or [None]
     elif callback.data == 'next_page':
-        page = data['page'] + 1
+        cursors = [*cursors, data['next_cursor']]
 
-    await state.update_data(page=page)
-    builder = await get_paginated_builder(state, page)
+    markup, next_cursor = await get_paginated_markup(state, cursors)
+    if not markup:
+        await callback.answer('К сожалению, там пока ничего нет')
+        return
 
-    await callback.message.edit_reply_markup(callback.inline_message_id, reply_markup=builder.as_markup())
+    await state.update_data(cursors=cursors, next_cursor=next_cursor)
+    await callback.message.edit_reply_markup(callback.inline_message_id, reply_markup=markup)
     await callback.answer()
 
 
+# Search
+
+# Инлайн-запросы с этим словом в начале ищут товары, остальные обрабатывает FAQ
+PRODUCT_SEARCH_PREFIX = 'товар '
+PRODUCT_SEARCH_QUERY = re.compile(r'^товар(\s|$)', re.IGNORECASE)
+
+
+def build_product_article(product: Product) -> types.InlineQueryResultArticle:
+    return types.InlineQueryResultArticle(
+        id=str(product.id),
+        title=product.name,
+        description=f'{product.price} руб. {product.description[:50]}',
+        thumbnail_url=product.image,
+        input_message_content=types.InputTextMessageContent(message_text=f'{product.name}: {product.price} руб.'),
+        # Ведет в тот же сценарий, что и кнопка товара в каталоге
+        reply_markup=InlineKeyboardBuilder(
+            [[InlineKeyboardButton(text='Подробнее', callback_data=f'product_{product.id}')]]
+        ).as_markup(),
+    )
+
+
+@router.inline_query(F.query.regexp(PRODUCT_SEARCH_QUERY))
+@inject
+async def inline_product_search(
+    inline_query: types.InlineQuery,
+    repository: AsyncContextManager[Repository] = Provide[Container.repository],
+):
+    words = normalize_query(inline_query.query)[1:]
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+
+    async with repository as repo:
+        items, has_next = await repo.search_products(words, PRODUCT_SEARCH_PAGE_SIZE, offset)
+
+    await inline_query.answer(
+        [build_product_article(product) for product in items],
+        cache_time=PRODUCT_INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=str(offset + PRODUCT_SEARCH_PAGE_SIZE) if has_next else '',
+    )
+
+
 # Handlers
 
 @router.message(F.text.lower() == 'каталог')
 async def catalog_handler(message: Message, state: FSMContext) -> None:
     await state.set_state(PaginationState.category)
-    page = 0
+    cursors = [None]
 
-    if builder := await get_paginated_builder(state, page):
-        await state.update_data(page=page)
-        await message.answer('Выберите категорию:', reply_markup=builder.as_markup())
+    markup, next_cursor = await get_paginated_markup(state, cursors)
+    if markup:
+        await state.update_data(cursors=cursors, next_cursor=next_cursor)
+        await message.answer('Выберите категорию:', reply_markup=markup)
     else:
         await message.answer('Тут пока ничего нет 😢')
 
@@ -136,6 +231,14 @@ async def product_detail_handler(
     async with repository as repo:
         product = await repo.get_product_by_id(product_id)
 
+    if product is None:
+        # Товар сняли с продажи после того, как была показана кнопка
+        if product_id in cart:
+            cart.delete(product_id)
+            await cart.save()
+        await callback.answer('Товар недоступен')
+        return
+
     kb = []
 
     if product_id in cart:
@@ -151,13 +254,19 @@ async def product_detail_handler(
     )
     caption = escape_markdown_v2(base_caption)
 
-    await callback.message.bot.send_photo(
-        callback.message.chat.id,
-        product.image,
-        caption=caption,
-        reply_markup=builder.as_markup(),
-        parse_mode=ParseMode.MARKDOWN_V2,
-    )
+    # У сообщения из инлайн-поиска callback.message отсутствует, поэтому отвечаем в личный чат
+    try:
+        await callback.bot.send_photo(
+            callback.from_user.id,
+            product.image,
+            caption=caption,
+            reply_markup=builder.as_markup(),
+            parse_mode=ParseMode.MARKDOWN_V2,
+        )
+    except (TelegramForbiddenError, TelegramBadRequest):
+        # Пользователь открыл карточку из инлайн-результата, но не запускал бота или заблокировал его
+        await callback.answer('Откройте бота и нажмите /start, чтобы посмотреть товар', show_alert=True)
+        return
     await callback.answer()
 
 
@@ -167,13 +276,15 @@ async def products(callback: CallbackQuery, state: FSMContext) -> None:
 
     _, subcategory = callback.data.split('_')
     await state.update_data(subcategory=subcategory)
-    page = 0
+    cursors = [None]
 
-    if builder := await get_paginated_builder(state, page):
-        await callback.message.edit_text('Выберите товар:', reply_markup=builder.as_markup())
-        await state.update_data(page=page)
+    markup, next_cursor = await get_paginated_markup(state, cursors)
+    if markup:
+        await callback.message.edit_text('Выберите товар:', reply_markup=markup)
+        await state.update_data(cursors=cursors, next_cursor=next_cursor)
         await callback.answer()
     else:
+        # Пустые ветки в каталоге не показываются, сюда попадают по кнопке, устаревшей после правки в админке
         await callback.answer('К сожалению, там пока ничего нет')
         await state.set_state(PaginationState.subcategory)
 
@@ -184,11 +295,12 @@ async def subcategories(callback: CallbackQuery, state: FSMContext) -> None:
 
     await state.set_state(PaginationState.subcategory)
     await state.update_data(category=category)
-    page = 0
+    cursors = [None]
 
-    if builder := await get_paginated_builder(state, page):
-        await callback.message.edit_text('Выберите подкатегорию:', reply_markup=builder.as_markup())
-        await state.update_data(page=page)
+    markup, next_cursor = await get_paginated_markup(state, cursors)
+    if markup:
+        await callback.message.edit_text('Выберите подкатегорию:', reply_markup=markup)
+        await state.update_data(cursors=cursors, next_cursor=next_cursor)
         await callback.answer()
     else:
         await callback.answer('К сожалению, там пока ничего нет')
@@ -208,6 +320,12 @@ async def cart_handler(
     async with repository as repo:
         product = await repo.get_product_by_id(product_id)
 
+    if product is None:
+        cart.delete(product_id)
+        await cart.save()
+        await callback.answer('Товар недоступен')
+        return
+
     match action:
         case 'add' | 'plus':
             cart.add(product)
@@ -243,10 +361,14 @@ async def product_info_handler(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == 'catalog')
 async def categories_on_return_button(callback: CallbackQuery, state: FSMContext) -> None:
-    page = 0
-    await state.update_data(page=page)
+    cursors = [None]
     await state.set_state(PaginationState.category)
 
-    builder = await get_paginated_builder(state, page)
-    await callback.message.edit_text('Выберите категорию:', reply_markup=builder.as_markup())
+    markup, next_cursor = await get_paginated_markup(state, cursors)
+    if not markup:
+        await callback.answer('Тут пока ничего нет 😢')
+        return
+
+    await state.update_data(cursors=cursors, next_cursor=next_cursor)
+    await callback.message.edit_text('Выберите категорию:', reply_markup=markup)
     await callback.answer()
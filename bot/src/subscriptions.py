@@ -0,0 +1,63 @@
+import asyncio
+import logging
+
+from aiogram import Bot
+
+from db.cache import TTLCache
+
+SUBSCRIBED_STATUSES = {'member', 'administrator', 'creator'}
+
+# chat_member-апдейт приходит в один процесс, остальные процессы и реплики узнают о нем через NOTIFY
+SUBSCRIPTION_CHANNEL = 'subscription_changed'
+
+
+class SubscriptionChecker:
+    """Проверка подписки пользователя на обязательные каналы.
+
+    Каналы опрашиваются параллельно, результат кэшируется на пользователя.
+    Отказ хранится недолго, чтобы только что подписавшийся пользователь не ждал
+    истечения TTL, если бот не получает chat_member-апдейты этого канала.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        channels: list[int | str],
+        ttl: float = 300.0,
+        negative_ttl: float = 30.0,
+        maxsize: int = 10_000,
+    ):
+        self._bot = bot
+        self.channels = channels
+        self._subscribed = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._not_subscribed = TTLCache(maxsize=maxsize, ttl=negative_ttl)
+
+    async def is_subscribed(self, user_id: int) -> bool:
+        if not self.channels or self._subscribed.get(user_id):
+            return True
+        if self._not_subscribed.get(user_id):
+            return False
+
+        results = await asyncio.gather(*(self._check(channel, user_id) for channel in self.channels))
+        if all(results):
+            self._subscribed.set(user_id, True)
+            return True
+        self._not_subscribed.set(user_id, True)
+        return False
+
+    def invalidate(self, user_id: int) -> None:
+        """Вызывается на chat_member-апдейт: пользователь подписался или отписался."""
+        self._subscribed.discard(user_id)
+        self._not_subscribed.discard(user_id)
+
+    def clear(self) -> None:
+        self._subscribed.clear()
+        self._not_subscribed.clear()
+
+    async def _check(self, channel: int | str, user_id: int) -> bool:
+        try:
+            member = await self._bot.get_chat_member(chat_id=channel, user_id=user_id)
+        except Exception as e:
+            logging.warning('Не удалось проверить подписку %s на %s: %s', user_id, channel, e)
+            return False
+        return member.status in SUBSCRIBED_STATUSES
@@ -0,0 +1,64 @@
+import abc
+import asyncio
+from typing import Any
+
+_STOP = object()
+
+
+class BatchWriter(abc.ABC):
+    """Фоновая запись пачками: элементы копятся в очереди и передаются в _flush.
+
+    Пачка собирается из всего, что уже накопилось, но не дольше flush_interval
+    и не больше batch_size элементов. При остановке очередь дописывается до конца.
+    Наследники реализуют только _flush.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float):
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+    @property
+    def depth(self) -> int:
+        """Число элементов, ожидающих записи."""
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._queue.put_nowait(_STOP)
+        await self._task
+        self._task = None
+
+    def _put(self, item: Any) -> None:
+        self._queue.put_nowait(item)
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = [await self._queue.get()]
+
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), max(timeout, 0)))
+                except TimeoutError:
+                    break
+
+            if _STOP in batch:
+                stopping = True
+                batch = [item for item in batch if item is not _STOP]
+                while not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+
+            if batch:
+                await self._flush(batch)
+
+    @abc.abstractmethod
+    async def _flush(self, batch: list) -> None:
+        """Записывает пачку. Исключения не должны выходить наружу, иначе запись остановится."""
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from metrics import BROADCAST_MESSAGES, BROADCAST_RETRIES
+
+
+class TokenBucket:
+    """Асинхронный token bucket: в среднем не больше rate операций в секунду."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def set_rate(self, rate: float) -> None:
+        self.rate = self.capacity = rate
+        self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает выдачу токенов, например, после RetryAfter от Telegram."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class ChatLimiter:
+    """Минимальный интервал между сообщениями в один чат."""
+
+    def __init__(self, interval: float = 1.0, max_chats: int = 10_000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._last_sent: dict[int, float] = {}
+
+    async def acquire(self, chat_id: int) -> None:
+        if (last := self._last_sent.get(chat_id)) is not None:
+            if (delay := last + self.interval - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+        self._last_sent[chat_id] = time.monotonic()
+
+        if len(self._last_sent) > self.max_chats:
+            threshold = time.monotonic() - self.interval
+            self._last_sent = {k: v for k, v in self._last_sent.items() if v > threshold}
+
+
+@dataclass
+class BroadcastStats:
+    total: int | None = None
+    sent: int = 0
+    failed: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started_at
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        if self.total is None or not self.rate:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+    def __str__(self):
+        eta = f'{self.eta:.0f} с' if self.eta is not None else '?'
+        return (
+            f'отправлено {self.sent}, ошибок {self.failed}, всего {self.total or "?"}, '
+            f'{self.rate:.1f} сообщ./с, осталось ~{eta}'
+        )
+
+
+class Broadcaster:
+    """Рассылка сообщений пулом конкурентных отправителей с ограничением скорости.
+
+    send(chat_id) должен пробрасывать исключения aiogram: по ним выбирается
+    повтор (RetryAfter, сетевые ошибки) или отказ (бот заблокирован и т.п.).
+    """
+
+    def __init__(
+        self,
+        send: Callable[[int], Awaitable],
+        *,
+        rate: float = 28.0,
+        workers: int = 16,
+        chat_interval: float = 1.0,
+        max_retries: int = 3,
+        backoff: float = 1.0,
+        progress_interval: float = 15.0,
+    ):
+        self._send = send
+        self._bucket = TokenBucket(rate)
+        self._chat_limiter = ChatLimiter(chat_interval)
+        self._queue: asyncio.Queue[int] = asyncio.Queue(maxsize=workers * 4)
+        self._workers_count = workers
+        self._workers: list[asyncio.Task] = []
+        self._reporter: asyncio.Task | None = None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.progress_interval = progress_interval
+        self.stats = BroadcastStats()
+
+    def start(self, total: int | None = None) -> None:
+        self.stats = BroadcastStats(total=total)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._workers_count)]
+        self._reporter = asyncio.create_task(self._report())
+
+    async def submit(self, chat_id: int) -> None:
+        await self._queue.put(chat_id)
+
+    async def join(self) -> None:
+        """Ждет, пока будут обработаны все отправленные в submit чаты."""
+        await self._queue.join()
+
+    def set_rate(self, rate: float) -> None:
+        if rate != self._bucket.rate:
+            logging.info('Скорость рассылки: %.1f сообщ./с', rate)
+            self._bucket.set_rate(rate)
+
+    def discard(self) -> int:
+        """Убирает из очереди чаты, которые отправители еще не взяли. Возвращает их количество."""
+        dropped = 0
+        while True:
+            try:
+                self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return dropped
+            self._queue.task_done()
+            dropped += 1
+
+    async def close(self) -> BroadcastStats:
+        await self.join()
+        for task in [*self._workers, self._reporter]:
+            task.cancel()
+        await asyncio.gather(*self._workers, self._reporter, return_exceptions=True)
+        return self.stats
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._queue.get()
+            try:
+                await self._deliver(chat_id)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, chat_id: int) -> None:
+        for attempt in range(self.max_retries + 1):
+            await self._chat_limiter.acquire(chat_id)
+            await self._bucket.acquire()
+            try:
+                await self._send(chat_id)
+                self.stats.sent += 1
+                BROADCAST_MESSAGES.labels('sent').inc()
+                return
+            except TelegramRetryAfter as e:
+                # Лимит общий для бота, поэтому притормаживаем всех отправителей
+                logging.warning('Telegram просит подождать %s с', e.retry_after)
+                BROADCAST_RETRIES.labels('retry_after').inc()
+                self._bucket.pause(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logging.warning('Ошибка отправки в %s, попытка %s: %s', chat_id, attempt + 1, e)
+                BROADCAST_RETRIES.labels('network').inc()
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Пользователь заблокировал бота или чат недоступен - повтор не поможет
+                logging.info('Сообщение в %s не доставлено: %s', chat_id, e)
+                break
+            except Exception:
+                logging.exception('Ошибка отправки в %s', chat_id)
+                break
+        self.stats.failed += 1
+        BROADCAST_MESSAGES.labels('failed').inc()
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            logging.info('Рассылка: %s', self.stats)
@@ -0,0 +1,79 @@
+import logging
+from dataclasses import dataclass
+
+from dependency_injector.providers import Factory
+
+from db.models import Order
+from metrics import ORDER_QUEUE_DEPTH
+
+from .batching import BatchWriter
+
+
+@dataclass(frozen=True, slots=True)
+class OrderPaid:
+    order: Order
+
+
+@dataclass(frozen=True, slots=True)
+class OrderRefunded:
+    provider_payment_charge_id: str
+
+
+OrderEvent = OrderPaid | OrderRefunded
+
+
+class OrderWriter(BatchWriter):
+    """Фоновая запись событий заказов в базу.
+
+    Хэндлеры только кладут событие в очередь и сразу отвечают пользователю.
+    Писатель забирает события пачками и применяет каждую пачку в одной транзакции
+    на одном соединении из пула. При остановке очередь дописывается до конца.
+    """
+
+    def __init__(
+        self,
+        repository: Factory,
+        batch_size: int = 50,
+        flush_interval: float = 0.5,
+        warn_depth: int = 500,
+    ):
+        super().__init__(batch_size, flush_interval)
+        self._repository = repository
+        self.warn_depth = warn_depth
+        # Значение читается при каждом опросе /metrics
+        ORDER_QUEUE_DEPTH.set_function(lambda: self.depth)
+
+    def submit(self, event: OrderEvent) -> None:
+        self._put(event)
+        if self.depth > self.warn_depth:
+            logging.warning('Очередь записи заказов: %s событий', self.depth)
+
+    async def _flush(self, batch: list[OrderEvent]) -> None:
+        try:
+            async with await self._repository.async_() as repo:
+                for event in batch:
+                    await self._apply(repo, event)
+        except Exception:
+            logging.exception('Не удалось записать пачку из %s событий, пишу по одному', len(batch))
+            for event in batch:
+                try:
+                    async with await self._repository.async_() as repo:
+                        await self._apply(repo, event)
+                except Exception:
+                    logging.exception('Событие заказа не записано: %r', event)
+
+    @staticmethod
+    async def _apply(repo, event: OrderEvent) -> None:
+        match event:
+            case OrderPaid(order=order):
+                order_id = await repo.add_order(order)
+                if order_id is None:
+                    logging.warning('Платеж %s уже сохранен', order.provider_payment_charge_id)
+                else:
+                    logging.info('Новый заказ %s от %s', order_id, order.client_username)
+            case OrderRefunded(provider_payment_charge_id=charge_id):
+                order_id = await repo.refund_order(charge_id)
+                if order_id is None:
+                    logging.warning('Возврат по платежу %s: заказ не найден или уже возвращен', charge_id)
+                else:
+                    logging.info('Возврат средств по заказу %s', order_id)
@@ -1,50 +1,329 @@
+import asyncio
 import datetime as dt
 import logging
-from typing import AsyncContextManager
+import time
+from functools import partial
 
 from aiogram.enums.parse_mode import ParseMode
+from aiogram.types import InlineKeyboardMarkup, Message, URLInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from dependency_injector.providers import Factory
 from dependency_injector.wiring import Provide, inject
 
-from config import bot, Container
-from db.models import Promo
-from db.repository import Repository
+from config import (
+    BROADCAST_RATE,
+    BROADCAST_WORKERS,
+    PROMO_BATCH_SIZE,
+    PROMO_PREVIEW_CHAT_ID,
+    PROMO_RETRY_DELAY,
+    PROMO_SHARD_LEASE,
+    PROMO_SHARD_SIZE,
+    REPLICA_ID,
+    bot,
+    Container,
+)
+from db.models import Promo, PromoShard
+from metrics import PROMOTE_DURATION
 from utils import escape_markdown_v2
 
+from .broadcast import Broadcaster
 
-async def notify_user(user_id, promo: Promo):
+# Админка уведомляет бота о сохранении или удалении промо
+PROMO_CHANNEL = 'promo_changed'
+
+
+def build_promo_markup(promo: Promo) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.button(text=promo.text_link, url=promo.link)
+    return kb.as_markup()
 
-    caption = escape_markdown_v2(promo.text)
+
+class PromoCover:
+    """Обложка промо: после первой успешной отправки используется file_id.
+
+    Повторно картинку по URL Telegram уже не скачивает, что ускоряет каждую отправку
+    и убирает ошибки загрузки с чужого хоста.
+    """
+
+    def __init__(self, promo: Promo):
+        self.url = promo.cover
+        self.file_id = promo.cover_file_id
+
+    @property
+    def photo(self) -> str | URLInputFile:
+        return self.file_id or URLInputFile(self.url)
+
+    def remember(self, message: Message) -> None:
+        if self.file_id is None and message.photo:
+            self.file_id = message.photo[-1].file_id
+
+
+async def upload_cover(cover: PromoCover, caption: str, markup: InlineKeyboardMarkup) -> None:
+    """Загружает обложку в служебный чат до начала рассылки (заодно это превью промо)."""
+    if cover.file_id or PROMO_PREVIEW_CHAT_ID is None:
+        return
     try:
-        await bot.send_photo(
-            chat_id=user_id,
-            photo=promo.cover,
-            caption=caption,
-            parse_mode=ParseMode.MARKDOWN_V2,
-            reply_markup=kb.as_markup()
-        )
+        await notify_user(PROMO_PREVIEW_CHAT_ID, cover, caption, markup)
     except Exception as e:
-        logging.error(str(e))
+        logging.error('Не удалось загрузить обложку промо: %s', e)
+
+
+async def notify_user(user_id, cover: PromoCover, caption: str, markup: InlineKeyboardMarkup):
+    # Ошибки обрабатывает Broadcaster: повторяет отправку или считает неудачной
+    message = await bot.send_photo(
+        chat_id=user_id,
+        photo=cover.photo,
+        caption=caption,
+        parse_mode=ParseMode.MARKDOWN_V2,
+        reply_markup=markup,
+    )
+    cover.remember(message)
+
+
+def broadcast_rate(replicas: int) -> float:
+    # Лимит Telegram общий для бота, реплики, ведущие рассылку, делят его поровну
+    return BROADCAST_RATE / max(replicas, 1)
+
+
+class ShardLease:
+    """Аренда шарда, которую фоновая задача продлевает каждые lease / 3 секунд.
+
+    Батч при лимите бота отправляется дольше аренды, поэтому продлевать ее только между
+    батчами нельзя. Чекпоинт last_id сдвигается после того, как батч отправлен целиком.
+    При каждом продлении скорость рассылки пересчитывается по числу реплик, держащих аренду.
+    """
+
+    def __init__(
+        self,
+        shard: PromoShard,
+        promo_id: int,
+        broadcaster: Broadcaster,
+        repository_provider: Factory,
+        lease: float = PROMO_SHARD_LEASE,
+    ):
+        self.shard = shard
+        self.last_id = shard.last_sent_user_id or shard.start_id
+        self.lost = asyncio.Event()
+        self._promo_id = promo_id
+        self._broadcaster = broadcaster
+        self._stats = broadcaster.stats
+        self._sent, self._failed = self._stats.sent, self._stats.failed
+        self._repository_provider = repository_provider
+        self._lease = lease
+        self._lock = asyncio.Lock()
+        self._heartbeat: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._heartbeat = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._heartbeat.cancel()
+        await asyncio.gather(self._heartbeat, return_exceptions=True)
+
+    async def renew(self) -> bool:
+        """Сохраняет чекпоинт и счетчики, продлевает аренду. False - аренду забрала другая реплика."""
+        async with self._lock:
+            if self.lost.is_set():
+                return False
+            sent, failed = self._stats.sent, self._stats.failed
+            async with await self._repository_provider.async_() as repo:
+                renewed = await repo.renew_promo_shard(
+                    self.shard.id, REPLICA_ID, self.last_id, sent - self._sent, failed - self._failed, self._lease,
+                )
+                replicas = await repo.count_promo_replicas(self._promo_id)
+            if not renewed:
+                logging.warning('Аренда шарда %s истекла и перешла другой реплике', self.shard.id)
+                self.lost.set()
+                return False
+            self._sent, self._failed = sent, failed
+            self._broadcaster.set_rate(broadcast_rate(replicas))
+            return True
+
+    async def _run(self) -> None:
+        while not self.lost.is_set():
+            await asyncio.sleep(self._lease / 3)
+            try:
+                await self.renew()
+            except Exception:
+                # Пока аренду никто не забрал, следующая попытка ее продлит
+                logging.exception('Не удалось продлить аренду шарда %s', self.shard.id)
+
+
+async def broadcast_shard(
+    shard: PromoShard,
+    promo: Promo,
+    cover: PromoCover,
+    broadcaster: Broadcaster,
+    repository_provider: Factory,
+) -> None:
+    """Рассылает шард, начиная с его чекпоинта, пока аренда шарда за этой репликой."""
+    lease = ShardLease(shard, promo.id, broadcaster, repository_provider)
+
+    async with await repository_provider.async_() as repo:
+        total = await repo.count_users(lease.last_id, shard.end_id)
+        broadcaster.set_rate(broadcast_rate(await repo.count_promo_replicas(promo.id)))
+    broadcaster.stats.total = (broadcaster.stats.total or 0) + total
+    logging.info(
+        'Шард %s промо %s: пользователи %s..%s, осталось %s', shard.id, promo.id, lease.last_id, shard.end_id, total,
+    )
+
+    # Соединение берется только на время чтения батча и продления аренды,
+    # после падения реплики шард продолжит другая с последнего сохраненного id
+    lease.start()
+    try:
+        while True:
+            async with await repository_provider.async_() as repo:
+                if cover.file_id != promo.cover_file_id:
+                    await repo.set_promo_cover_file_id(promo.id, cover.file_id)
+                    promo.cover_file_id = cover.file_id
+                user_ids = await repo.get_user_ids(lease.last_id, PROMO_BATCH_SIZE, shard.end_id)
+            if not user_ids:
+                break
+
+            for user_id in user_ids:
+                if lease.lost.is_set():
+                    # Шард досылает другая реплика, очередь не отправляем, чтобы не дублировать сообщения
+                    dropped = broadcaster.discard()
+                    logging.warning('Отправка шарда %s остановлена, из очереди убрано %s', shard.id, dropped)
+                    await broadcaster.join()
+                    return
+                await broadcaster.submit(user_id)
+                # Пока file_id неизвестен, отправляем по одному, чтобы картинку по URL загрузили один раз
+                if cover.file_id is None:
+                    await broadcaster.join()
+            await broadcaster.join()
+
+            lease.last_id = user_ids[-1]
+            if not await lease.renew():
+                return
+    finally:
+        await lease.stop()
+
+    async with await repository_provider.async_() as repo:
+        await repo.complete_promo_shard(shard.id, REPLICA_ID)
 
 
 @inject
-async def promote(repository: AsyncContextManager[Repository] = Provide[Container.repository]):
+async def promote(repository_provider: Factory = Provide[Container.repository.provider]) -> dt.datetime | None:
+    """Рассылает активное промо вместе с остальными репликами, забирая свободные шарды аудитории.
+
+    Возвращает время, когда освободится шард, занятый другой репликой (проверить промо снова),
+    или None, если промо нет или рассылка завершена.
+    """
     cur_time = dt.datetime.now(dt.UTC)
 
-    async with repository as repo:
+    async with await repository_provider.async_() as repo:
         promo = await repo.get_active_promo(cur_time)
 
         if not promo:
+            return None
+
+        shards = await repo.plan_promo_shards(promo.id, PROMO_SHARD_SIZE)
+
+    logging.info('Рассылка промо %s, шардов %s, реплика %s', promo.id, shards, REPLICA_ID)
+
+    # Подпись и клавиатура одинаковые для всех получателей
+    caption = escape_markdown_v2(promo.text)
+    markup = build_promo_markup(promo)
+
+    cover = PromoCover(promo)
+    await upload_cover(cover, caption, markup)
+
+    broadcaster = Broadcaster(
+        partial(notify_user, cover=cover, caption=caption, markup=markup),
+        rate=BROADCAST_RATE,
+        workers=BROADCAST_WORKERS,
+    )
+    broadcaster.start()
+
+    try:
+        while True:
+            async with await repository_provider.async_() as repo:
+                shard = await repo.claim_promo_shard(promo.id, REPLICA_ID, PROMO_SHARD_LEASE)
+            if shard is None:
+                break
+            await broadcast_shard(shard, promo, cover, broadcaster, repository_provider)
+    finally:
+        stats = await broadcaster.close()
+        PROMOTE_DURATION.observe(time.monotonic() - stats.started_at)
+    logging.info('Реплика %s закончила свою часть рассылки промо %s: %s', REPLICA_ID, promo.id, stats)
+
+    # Промо отключит реплика, завершившая последний шард
+    async with await repository_provider.async_() as repo:
+        if await repo.finish_promo(promo.id, cur_time):
+            logging.info('Рассылка промо %s выполнена', promo.id)
+            return None
+        return await repo.get_promo_lease_expiry(promo.id)
+
+
+class PromoScheduler:
+    """Запускает рассылку в start_time ближайшего активного промо, без опроса базы по таймеру.
+
+    В планировщике всегда не больше одной разовой задачи. Она переставляется после каждой
+    рассылки и по уведомлению PROMO_CHANNEL, когда промо меняют в админке.
+    В процессе одновременно выполняется только одна рассылка, между репликами ее делят шарды.
+    """
+
+    JOB_ID = 'promote'
+
+    def __init__(
+        self,
+        scheduler: AsyncIOScheduler,
+        repository_provider: Factory,
+        retry_delay: float = PROMO_RETRY_DELAY,
+    ):
+        self._scheduler = scheduler
+        self._repository_provider = repository_provider
+        self._retry_delay = retry_delay
+        self._lock = asyncio.Lock()
+
+    async def arm(self, *_) -> None:
+        """Перечитывает ближайшее промо и переставляет задачу (аргументы уведомления не нужны)."""
+        if self._lock.locked():
+            # Идет рассылка, следующее промо запланируется по ее окончании
             return
 
-        logging.info('Получено новое промо, начинаю')
+        async with await self._repository_provider.async_() as repo:
+            start_time = await repo.get_next_promo_time()
+
+        if start_time is None:
+            if self._scheduler.get_job(self.JOB_ID):
+                self._scheduler.remove_job(self.JOB_ID)
+            return
+        self._schedule(start_time)
 
-        async for row in repo.get_users_by_batch():
-            await notify_user(row.get('id'), promo)
+    def _schedule(self, run_date: dt.datetime) -> None:
+        # misfire_grace_time=None: задача, опоздавшая из-за занятого цикла событий, все равно выполнится
+        self._scheduler.add_job(
+            self._run, 'date', run_date=run_date, id=self.JOB_ID, replace_existing=True, misfire_grace_time=None,
+        )
+        logging.info('Рассылка промо запланирована на %s', run_date)
+
+    async def _run(self) -> None:
+        if self._lock.locked():
+            return
+
+        async with self._lock:
+            try:
+                check_at = await promote(self._repository_provider)
+            except Exception:
+                logging.exception('Рассылка промо прервана, повтор через %s с', self._retry_delay)
+                self._retry()
+                return
+
+        if check_at is not None:
+            # Оставшиеся шарды у других реплик: если какая-то из них упадет, ее шард заберем мы.
+            # Секунда запаса на расхождение часов с базой
+            self._schedule(max(check_at, dt.datetime.now(dt.UTC)) + dt.timedelta(seconds=1))
+            return
 
-        logging.info('Рассылка промо выполнена, %s', promo)
+        try:
+            await self.arm()
+        except Exception:
+            logging.exception('Не удалось запланировать следующее промо, повтор через %s с', self._retry_delay)
+            self._retry()
 
-        # Обновить последнее успешное выполнение и отключить рассылку
-        await repo.update_promo(promo.id, cur_time)
+    def _retry(self) -> None:
+        # Рассылка продолжится с чекпоинта
+        self._schedule(dt.datetime.now(dt.UTC) + dt.timedelta(seconds=self._retry_delay))
@@ -0,0 +1,57 @@
+import logging
+
+from aiogram.types import User
+from dependency_injector.providers import Factory
+
+from .batching import BatchWriter
+
+
+class UserRegistrar(BatchWriter):
+    """Регистрация пользователей бота без запроса к базе на каждый /start.
+
+    id всех зарегистрированных пользователей держатся в памяти (загружаются при старте),
+    повторный /start проверяется по ним. Новые пользователи копятся в очереди
+    и записываются пачками одним INSERT ... ON CONFLICT DO NOTHING.
+    """
+
+    def __init__(
+        self,
+        repository: Factory,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        load_batch_size: int = 10_000,
+    ):
+        super().__init__(batch_size, flush_interval)
+        self._repository = repository
+        self._known: set[int] = set()
+        self.load_batch_size = load_batch_size
+
+    async def load(self) -> None:
+        after_id = 0
+        async with await self._repository.async_() as repo:
+            while user_ids := await repo.get_user_ids(after_id, self.load_batch_size):
+                self._known.update(user_ids)
+                after_id = user_ids[-1]
+        logging.info('Загружено пользователей: %s', len(self._known))
+
+    def register(self, user: User) -> bool:
+        """Ставит пользователя в очередь на запись, если он еще не известен. Не ждет базу."""
+        if user.id in self._known:
+            return False
+        self._known.add(user.id)
+        self._put(user)
+        return True
+
+    async def _flush(self, batch: list[User]) -> None:
+        try:
+            async with await self._repository.async_() as repo:
+                added = set(await repo.add_users(batch))
+        except Exception:
+            logging.exception('Не удалось зарегистрировать %s пользователей', len(batch))
+            # Забываем их, чтобы следующий /start попробовал еще раз
+            self._known.difference_update(user.id for user in batch)
+            return
+
+        for user in batch:
+            if user.id in added:
+                logging.info('Новый пользователь @%s(%s)', user.username, user.id)
@@ -1,51 +1,49 @@
-import os
+import asyncio
 import re
+import typing
 
-from openpyxl import Workbook, load_workbook
+from openpyxl import Workbook
 
 ORDERS_FILE = 'orders.xlsx'
 
+ORDER_STATUSES = {
+    'paid': 'Оплачено',
+    'refunded': 'Возврат средств',
+}
 
-def update_order_on_refund(provider_payment_charge_id):
-    wb = load_workbook(ORDERS_FILE)
-    ws = wb.active
+# Длинные запросы обрезаются: больше слов выборку уже не сужают, а ключей в кэше станет больше
+MAX_QUERY_WORDS = 8
 
-    # В openpyxl индексирование начинается с 1
-    # Payment Charge ID (2-й столбец) и Paid (7-й столбец)
-    payment_charge_col = 2
-    paid_col = 7
 
-    for row in range(2, ws.max_row + 1):  # Пропускаем заголовок
-        if ws.cell(row=row, column=payment_charge_col).value == provider_payment_charge_id:
-            ws.cell(row=row, column=paid_col).value = 'Возврат средств'
+def format_order_row(order: dict) -> list:
+    products_str = '; '.join([f"ID: {item['id']}, Name: {item['name']}, Price: {item['price']}, Qty: {item['quantity']}"
+                             for item in order['items'] or []])
+    return [
+        products_str,
+        order['provider_payment_charge_id'],
+        order['paid_amount'],
+        order['fio'],
+        order['phone'],
+        order['address'],
+        ORDER_STATUSES.get(order['status'], order['status']),
+        order['client_username'],
+    ]
 
-    wb.save('orders-updated.xlsx')
 
+def write_orders_xlsx(rows: list[list], path: str = ORDERS_FILE) -> None:
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(['Products', 'Payment Charge ID', 'Paid Amount', 'FIO', 'Phone', 'Address', 'Paid', 'Client Username'])
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
 
-def save_order(
-    client_username,
-    products: list[tuple],
-    provider_payment_charge_id,
-    paid_amount,
-    fio,
-    phone,
-    address,
-):
-    if os.path.exists(ORDERS_FILE):
-        wb = load_workbook(ORDERS_FILE)
-    else:
-        wb = Workbook()
-        ws = wb.active
-        ws.append(
-            ['Products', 'Payment Charge ID', 'Paid Amount', 'FIO', 'Phone', 'Address', 'Paid', 'Client Username']
-        )
 
-    ws = wb.active
-    products_str = '; '.join([f"ID: {pid}, Name: {info['name']}, Price: {info['price']}, Qty: {info['quantity']}"
-                             for pid, info in products])
-
-    ws.append([products_str, provider_payment_charge_id, paid_amount, fio, phone, address, 'Оплачено', client_username])
-    wb.save(ORDERS_FILE)
+async def export_orders(orders: typing.AsyncIterator[dict], path: str = ORDERS_FILE) -> None:
+    """Выгрузка заказов из базы в Excel. Файл только производный, источник правды - таблица panel_order."""
+    rows = [format_order_row(order) async for order in orders]
+    # openpyxl блокирующий, сборку и запись файла выносим из event loop
+    await asyncio.to_thread(write_orders_xlsx, rows, path)
 
 
 def are_keyboards_equal(current_keyboard, new_keyboard):
@@ -65,3 +63,8 @@ def escape_markdown_v2(text: str) -> str:
     """Экранирование зарезервированных символов для MarkdownV2."""
     reserved_chars = r'([-\.!#])'
     return re.sub(reserved_chars, r'\\\1', text)
+
+
+def normalize_query(text: str) -> tuple[str, ...]:
+    """Приводит поисковый запрос к ключу кэша: "Как  сменить Пароль?" -> ('как', 'сменить', 'пароль')."""
+    return tuple(re.findall(r'\w+', text.lower()))[:MAX_QUERY_WORDS]
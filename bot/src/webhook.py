@@ -0,0 +1,49 @@
+import datetime as dt
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from dependency_injector.providers import Factory
+
+
+class UpdateDedupMiddleware(BaseMiddleware):
+    """Отбрасывает повторно доставленные апдейты.
+
+    Telegram повторяет запрос, если не дождался ответа, и повтор может попасть
+    в другой воркер, поэтому кроме локального набора id проверяется таблица
+    panel_processedupdate. Апдейт обрабатывается в фоне после ответа 200, поэтому
+    ошибка хэндлера повторной доставки не вызывает, и отметка не снимается.
+    """
+
+    def __init__(self, repository: Factory, local_size: int = 10_000):
+        self._repository = repository
+        self._seen: OrderedDict[int, None] = OrderedDict()
+        self.local_size = local_size
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        if event.update_id in self._seen:
+            return
+        self._seen[event.update_id] = None
+        if len(self._seen) > self.local_size:
+            self._seen.popitem(last=False)
+
+        async with await self._repository.async_() as repo:
+            if not await repo.mark_update_processed(event.update_id):
+                logging.info('Повторный апдейт %s пропущен', event.update_id)
+                return
+
+        # Апдейт помечается до обработки, чтобы повтор в другом воркере не обработался параллельно
+        return await handler(event, data)
+
+
+async def cleanup_processed_updates(repository: Factory, keep: dt.timedelta = dt.timedelta(days=1)) -> None:
+    # Telegram не повторяет доставку дольше суток, старые id больше не нужны
+    async with await repository.async_() as repo:
+        await repo.delete_processed_updates(dt.datetime.now(dt.UTC) - keep)